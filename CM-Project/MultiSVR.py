@@ -0,0 +1,176 @@
+import numpy as np
+import time
+import math
+import kernel
+from SVR import SVR, _save_state, _load_state
+from deflected_subgradient import solveDeflectedMulti
+
+class MultiSVR:
+    """
+    Class' objective is to handle many Support Vector Regression models sharing the same kernel (e.g. the two ML-CUP outputs),
+    building the kernel once and solving all the outputs together:
+        'constructor' to initialize
+        'fit' to train all the models at once
+        'predict' to test all the models at once
+    Each output is still a standalone SVR instance, available in 'models'.
+    """
+    def __init__(self, kernel, kernel_args={}, box=1.0, eps=0.1, n_outputs=2):
+        """ Initialize multi output svr model only with model parameters
+
+        Args:
+            kernel (string): can either be 'linear' 'poly' 'sigmoid' or 'rbf', shared by all outputs
+            kernel_args (dict, optional): contains parameters specific to kernel, therefore 'gamma' 'degree' and 'coefficient'. Defaults to {}.
+            box (float or list, optional): model 'C' parameter, either shared or one per output. Defaults to 1.0.
+            eps (float or list, optional): model epsilon tube width parameter, either shared or one per output. Defaults to 0.1.
+            n_outputs (int, optional): number of output dimensions. Defaults to 2.
+        """
+        self.kernel = kernel
+        self.n_outputs = n_outputs
+        boxes = np.broadcast_to(box, (n_outputs,))
+        epss = np.broadcast_to(eps, (n_outputs,))
+        self.models = [SVR(kernel, kernel_args, float(boxes[i]), float(epss[i])) for i in range(n_outputs)]
+
+    def __str__(self):
+        """Function to print out model
+
+        Returns:
+            string: string representing all the output models
+        """
+        return ''.join(f"\nOutput {i}:" + str(model) for i, model in enumerate(self.models))
+
+    def fit(self, x, y, optim_args, target_func_value=None, max_error_target_func_value=None, beta_init=None, precomp_kernel=None, optim_verbose=True, fit_time=True, keep_train_state=True):
+        """Function to fit all the output models together, given data and parameters relating to the algorithm
+
+        Args:
+            x (np.array): input data
+            y (np.array): output data, one column per output
+            optim_args (dict or list): dictionary containing all algorithmic parameters relating to deflected subgradient, either shared or one per output
+            target_func_value (float or list, optional): necessary if 'accepted' convergence condition is wanted. Defaults to None.
+            max_error_target_func_value (float or list, optional): range of error around target_func_value to define 'accepted' convergence condition. Defaults to None.
+            beta_init (np.array, optional): initial values of lagrangian multiplier differences, one column per output. Each column has to sum to 0. Defaults to None.
+            precomp_kernel (list, optional): containing precomputed kernel in position 0, gamma value for the kernel in position 1. Defaults to None.
+            optim_verbose (bool, optional): if True then step by step details during optimization will be printed out. Defaults to True.
+            fit_time (bool, optional): if True then at end of fitting prints out number of SV as well as computation time. Defaults to True.
+            keep_train_state (bool, optional): if False then training data, kernel and optimization history are dropped after fitting. Defaults to True.
+        """
+        start = time.time()
+        y = np.asarray(y).reshape(-1, self.n_outputs)
+
+        # kernel is computed only once for all outputs
+        if precomp_kernel is None:
+            self.models[0].xs = x
+            K, gamma_value = kernel.get_kernel(self.models[0])
+        else:
+            K, gamma_value = precomp_kernel[0], precomp_kernel[1]
+
+        # initialize target goal and error if not present (means it is not needed for this run)
+        if target_func_value is None:
+            target_func_value = -math.inf
+            max_error_target_func_value = 1e-12
+
+        # every output gets its own copy of the algorithmic parameters, with its own epsilon-tube
+        optim_args = [optim_args]*self.n_outputs if isinstance(optim_args, dict) else optim_args
+        optim_args = [dict(args) for args in optim_args]
+        for args, model in zip(optim_args, self.models):
+            args['vareps'] = model.eps if 'vareps' not in args else args['vareps']
+
+        beta_init = np.zeros((x.shape[0], self.n_outputs)) if beta_init is None else beta_init
+        betas, status, history = solveDeflectedMulti(beta_init, y, K, [model.box for model in self.models], optim_args=optim_args,
+                                                     target_func_value=target_func_value, max_error_target_func_value=max_error_target_func_value,
+                                                     verbose=optim_verbose) # train all the models
+
+        # hand the shared results over to every single output model
+        for i, model in enumerate(self.models):
+            model.xs = x
+            model.ys = y[:, i]
+            model.optim_args = optim_args[i]
+            model.K, model.gamma_value = K, gamma_value
+            model.beta, model.status, model.history = np.vstack(betas[:, i]), status[i], history[i]
+            model.compute_sv()
+            if model.kernel == "linear":
+                model.W = np.asarray(model.sv.T.dot(model.betasv)).T
+        self.compute_sv()
+        if fit_time:
+            print(f"Fit time: {time.time() - start}, #SV: {[len(model.betasv) for model in self.models]}")
+        if not keep_train_state:
+            self.drop_train_state()
+
+    def drop_train_state(self):
+        """Function to release everything needed only during fitting, for all the output models
+        """
+        for model in self.models:
+            model.drop_train_state()
+
+    def compute_sv(self):
+        """Function to be called after fitting the output models, joins their support vectors so that
+        a single kernel evaluation is needed at prediction time
+        """
+        self.sv_indexes, first = np.unique(np.concatenate([model.sv_indexes for model in self.models]), return_index=True)
+        self.sv = kernel.vstack([model.sv for model in self.models])[first] # one row for each distinct support vector
+        self.betasv = np.zeros((self.sv_indexes.size, self.n_outputs)) # zero where the vector is not a support vector for that output
+        for i, model in enumerate(self.models):
+            self.betasv[np.searchsorted(self.sv_indexes, model.sv_indexes), i] = np.ravel(model.betasv)
+        self.intercept = np.vstack([np.ravel(model.intercept) for model in self.models])
+        if self.kernel == 'linear':
+            self.W = np.vstack([model.W for model in self.models])
+
+    def predict(self, x):
+        """Function to output all the models predictions on given data 'x'
+
+        Args:
+            x (np.array): input data, either a single pattern or a matrix of patterns (dense or sparse)
+
+        Returns:
+            np.array: output data, one row per output
+        """
+        if not kernel.issparse(x):
+            x = np.array([x]) if np.ndim(x) == 1 else np.asarray(x)
+        if self.kernel == 'linear':
+            # linear prediction is treated differently
+            return np.asarray(x.dot(self.W.T)).T + self.intercept
+
+        K = kernel.get_cross_kernel(self.models[0], self.sv, x) # shared by all outputs
+        return np.dot(self.betasv.T, K) + self.intercept
+
+    def predict_chunks(self, chunks):
+        """Function to predict a stream of input blocks (e.g. from 'get_cup_dataset._iter_cup_chunks'),
+        one cross-kernel block per chunk, so that memory stays bounded by the chunk size
+
+        Args:
+            chunks (iterable): blocks of input data, one pattern per row
+
+        Yields:
+            np.array: predictions of the block, one row per pattern and one column per output
+        """
+        for chunk in chunks:
+            yield self.predict(chunk).T
+
+    def save(self, path, mmap=False):
+        """Function to save all the fitted output models in a single compact '.npz' file
+
+        Args:
+            path (string or file): destination '.npz' file
+            mmap (bool, optional): if True then support vectors and their betas are saved in separate memory-mappable '.npy' files. Defaults to False.
+        """
+        state = {'n_outputs': np.array(self.n_outputs)}
+        for i, model in enumerate(self.models):
+            state.update(model._compact_state(prefix=f"out{i}_"))
+        _save_state(path, state, mmap)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Function to load a model saved with 'save', ready for prediction
+
+        Args:
+            path (string or file): '.npz' file written by 'save'
+            mmap_mode (string, optional): numpy memory-map mode (e.g. 'r') for arrays saved with 'mmap=True'. Defaults to None.
+
+        Returns:
+            MultiSVR: loaded model
+        """
+        state = _load_state(path, mmap_mode)
+        models = [SVR._from_compact_state(state, prefix=f"out{i}_") for i in range(int(state['n_outputs']))]
+        multi_model = cls(models[0].kernel, n_outputs=len(models))
+        multi_model.models = models
+        multi_model.compute_sv()
+        return multi_model
@@ -1,8 +1,11 @@
 import numpy as np
 import time
 import math
+import json
+import copy
 import kernel
-from deflected_subgradient import solveDeflected
+from deflected_subgradient import solveDeflected, convergenceRate, historyIterations
+from kp import solveKP
 import matplotlib.pyplot as plt
 
 class SVR:
@@ -12,7 +15,7 @@ class SVR:
         'fit' to train the model
         'predict' to test the model
     """
-    def __init__(self, kernel, kernel_args={}, box=1.0, eps=0.1):
+    def __init__(self, kernel, kernel_args={}, box=1.0, eps=0.1, dtype=np.float64):
         """ Initialize svr model only with model parameters
 
         Args:
@@ -20,17 +23,40 @@ class SVR:
             kernel_args (dict, optional): contains parameters specific to kernel, therefore 'gamma' 'degree' and 'coefficient'. Defaults to {}.
             box (float, optional): model 'C' parameter. Defaults to 1.0.
             eps (float, optional): model epsilon tube width parameter. Defaults to 0.1.
+            dtype (np.dtype, optional): floating point type of kernel, betas and solver buffers. np.float32 halves memory traffic
+                (objective value and knapsack sums are still accumulated in float64). Defaults to np.float64.
         """        
         self.kernel = kernel # string identifying model kernel
         self.box = box       # value for the C parameter, constraining the dual representation
         self.eps = eps       # value for epsilon-tube width
+        self.dtype = np.dtype(dtype) # working precision of kernel, solver and prediction
 
         # various parameters possible for kernels
         self.gamma  = kernel_args['gamma'] if 'gamma' in kernel_args else 'scale' 
         self.degree = kernel_args['degree'] if 'degree' in kernel_args else 1
         self.coef   = kernel_args['coef'] if 'coef' in kernel_args else 0
         self.optim_args = None # will save parameters needed for deflected subgradient optimization process
+        self.sv_tree = None # spatial index of the support vectors, used for fast rbf prediction (see 'build_fast_predict')
+        self.K_buffer = None # preallocated storage 'K' is a view of, grown by 'partial_fit'
     
+    def __getstate__(self):
+        """Pickle the model without the spare capacity of the kernel buffer ('K' itself is pickled)
+
+        Returns:
+            dict: attributes to pickle
+        """
+        state = self.__dict__.copy()
+        state['K_buffer'] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled model, giving default values to the attributes added after it was pickled
+
+        Args:
+            state (dict): pickled attributes
+        """
+        self.__dict__.update({'dtype': np.dtype(np.float64), 'sv_tree': None, 'K_buffer': None}, **state)
+
     def __str__(self):
         """Function to print out model 
 
@@ -56,11 +82,11 @@ class SVR:
         model_as_string += "\nBox: "+str(self.box)
         return model_as_string
 
-    def fit(self, x, y, optim_args, target_func_value=None, max_error_target_func_value=None, beta_init=None, precomp_kernel=None, optim_verbose=True, convergence_verbose=False, fit_time=True):
+    def fit(self, x, y, optim_args, target_func_value=None, max_error_target_func_value=None, beta_init=None, precomp_kernel=None, optim_verbose=True, convergence_verbose=False, fit_time=True, keep_train_state=True, optim_callback=None, callback_stride=1, history_stride=1, history_cap=None):
         """Function to fit model, given data and parameters relating to the algorithm
 
         Args:
-            x (np.array): input data
+            x (np.array): input data, either dense or sparse (scipy CSR)
             y (np.array): output data
             optim_args (dict): dictionary containing all algorithmic parameters relating to deflected subgradient
             target_func_value (float, optional): necessary if 'accepted' convergence condition is wanted. Defaults to None.
@@ -70,6 +96,11 @@ class SVR:
             optim_verbose (bool, optional): if True then step by step details during optimization will be printed out. Defaults to True.
             convergence_verbose (bool, optional): if True then at the end of fitting plots on convergence rate and logarithmic residual error will be shown (taking final fref as fstar/fbest). Defaults to False.
             fit_time (bool, optional): if True then at end of fitting prints out number of SV as well as computation time. Defaults to True.
+            keep_train_state (bool, optional): if False then training data, kernel and optimization history are dropped after fitting (see 'drop_train_state'). Defaults to True.
+            optim_callback (callable, optional): receives sampled iteration statistics during optimization (e.g. deflected_subgradient.SolverProfiler). Defaults to None.
+            callback_stride (int, optional): number of iterations between two 'optim_callback' calls. Defaults to 1.
+            history_stride (int, optional): one function value every 'history_stride' iterations is kept in history. Defaults to 1.
+            history_cap (int, optional): maximum number of function values kept in history (the last ones). Defaults to None.
         """
         start = time.time()
         # save input, output and optimization arguments
@@ -89,26 +120,86 @@ class SVR:
             max_error_target_func_value = 1e-12
         
         # it is possible to initialize betas beforehand if one desires (beta is lagrangian variable ensemble, explained in report section 2) 
-        beta_init = np.vstack(np.zeros(self.xs.shape[0])) if beta_init is None else beta_init
+        beta_init = np.vstack(np.zeros(self.xs.shape[0], dtype=self.dtype)) if beta_init is None else np.asarray(beta_init, dtype=self.dtype)
         optim_args['vareps'] = self.eps if 'vareps' not in optim_args else optim_args['vareps']
-        self.beta, self.status, self.history = solveDeflected(beta_init, self.ys, self.K, self.box, target_func_value=target_func_value, max_error_target_func_value=max_error_target_func_value, optim_args=optim_args, verbose=optim_verbose) # train the model
+        self.beta, self.status, self.history = solveDeflected(beta_init, self.ys, self.K, self.box, target_func_value=target_func_value, max_error_target_func_value=max_error_target_func_value, optim_args=optim_args, verbose=optim_verbose, callback=optim_callback, callback_stride=callback_stride, history_stride=history_stride, history_cap=history_cap) # train the model
         if convergence_verbose: # plot convergence rate - logaritmic residual error
             _, axs = plt.subplots(2)
-            plot_conv_rate = []
-            log_residual_error = []
-            for i in range(len(self.history['f']) - 1):
-                plot_conv_rate.append((self.history['f'][i+1] - self.history['fstar']) / (self.history['f'][i] - self.history['fstar']))
-                log_residual_error.append(np.log(np.abs(self.history['f'][i] - self.history['fstar']) / np.abs(self.history['fstar'])))
-            axs[0].plot(range(len(plot_conv_rate)), plot_conv_rate)
+            f, fstar, iterations = self.history['f'], self.history['fstar'], historyIterations(self.history)
+            plot_conv_rate = convergenceRate(f, iterations, fstar) # per iteration, also when values are recorded with a stride
+            log_residual_error = np.log(np.abs(f[:-1] - fstar) / np.abs(fstar))
+            axs[0].plot(iterations[:-1], plot_conv_rate)
             axs[0].set_ylabel("CONV_RATE")
-            axs[1].plot(range(len(log_residual_error)), log_residual_error)
+            axs[1].plot(iterations[:-1], log_residual_error)
             axs[1].set_ylabel("LOG_RESIDUAL_ERROR")
             plt.show()
         self.compute_sv() # compute support vectors given the final lagrangian values
         if self.kernel == "linear": # 'linear' kernel prediction method is different from the other kernels
-            self.W = np.dot(self.betasv.T, self.sv)
+            self.W = np.asarray(self.sv.T.dot(self.betasv)).T
         if fit_time:
             print(f"Fit time: {time.time() - start}, #SV: {len(self.betasv)}")
+        if not keep_train_state:
+            self.drop_train_state()
+
+    def partial_fit(self, x_new, y_new, optim_args=None, target_func_value=None, max_error_target_func_value=None, optim_verbose=False, fit_time=True):
+        """Function to update an already fitted model with new data, without starting over.
+        The cached kernel is only extended with the rows/columns of the new patterns (gamma value of the first fit is kept),
+        and the optimization restarts from the previous betas padded with zeros for the new patterns.
+        The kernel lives in a preallocated buffer whose capacity doubles when full, so that only the new blocks are written
+        (O(n*m) kernel evaluations for m new patterns, the n*n block is copied only when the buffer grows, at the cost of up to 4x the kernel memory).
+        The dual is still solved again over all the n+m patterns (warm started, the dual couples every pattern through the
+        equality constraint), so an update costs O(n^2) per solver iteration as a fit does, usually with far fewer iterations
+
+        Args:
+            x_new (np.array): new input data
+            y_new (np.array): new output data
+            optim_args (dict, optional): algorithmic parameters for the update. Defaults to None (same as the previous fit).
+            target_func_value (float, optional): necessary if 'accepted' convergence condition is wanted. Defaults to None.
+            max_error_target_func_value (float, optional): range of error around target_func_value to define 'accepted' convergence condition. Defaults to None.
+            optim_verbose (bool, optional): if True then step by step details during optimization will be printed out. Defaults to False.
+            fit_time (bool, optional): if True then at end of fitting prints out number of SV as well as computation time. Defaults to True.
+        """
+        if self.K is None:
+            raise ValueError("Model has no training state (see 'drop_train_state'), it has to be fitted from scratch")
+        start = time.time()
+        # extend the kernel only with the blocks involving the new patterns, written in place in the buffer
+        n, m = self.K.shape[0], x_new.shape[0]
+        if self.K_buffer is None or self.K.base is not self.K_buffer or self.K_buffer.shape[0] < n + m:
+            capacity = max(2*n, n + m) # doubling keeps the total copy cost of a sequence of updates linear in the final size
+            self.K_buffer = np.empty((capacity, capacity), dtype=self.K.dtype)
+            self.K_buffer[:n, :n] = self.K
+        K_cross = kernel.get_cross_kernel(self, self.xs, x_new)
+        self.K_buffer[:n, n:n+m] = K_cross
+        self.K_buffer[n:n+m, :n] = K_cross.T
+        self.K_buffer[n:n+m, n:n+m] = kernel.get_cross_kernel(self, x_new, x_new)
+        self.K = self.K_buffer[:n+m, :n+m]
+        self.xs = kernel.vstack([self.xs, x_new])
+        self.ys = np.concatenate([np.ravel(self.ys), np.ravel(y_new)])
+        self.optim_args = self.optim_args if optim_args is None else optim_args
+        self.optim_args['vareps'] = self.eps if 'vareps' not in self.optim_args else self.optim_args['vareps']
+
+        if target_func_value is None:
+            target_func_value = -math.inf
+            max_error_target_func_value = 1e-12
+
+        # previous betas padded with zeros are the warm start, projected to satisfy box and sum to zero constraints
+        beta_init = solveKP(self.box, 0, np.vstack([self.beta, np.zeros((x_new.shape[0], 1), dtype=self.dtype)]), False)
+        previous_f, previous_it = self.history['f'], historyIterations(self.history)
+        self.beta, self.status, self.history = solveDeflected(beta_init, self.ys, self.K, self.box, target_func_value=target_func_value, max_error_target_func_value=max_error_target_func_value, optim_args=self.optim_args, verbose=optim_verbose)
+        self.history['f'] = np.concatenate([previous_f, self.history['f']]) # keep the whole optimization history
+        self.history['it'] = np.concatenate([previous_it, self.history['it'] + (previous_it[-1] + 1 if len(previous_it) > 0 else 0)]) # update iterations follow the previous ones
+        self.compute_sv()
+        if self.kernel == "linear":
+            self.W = np.asarray(self.sv.T.dot(self.betasv)).T
+        if fit_time:
+            print(f"Partial fit time: {time.time() - start}, #SV: {len(self.betasv)}")
+
+    def drop_train_state(self):
+        """Function to release everything needed only during fitting (training data, kernel, full betas and f values history),
+        keeping what is needed for prediction. After this call the model occupies O(#SV) memory
+        """
+        self.xs, self.ys, self.K, self.beta, self.K_buffer = None, None, None, None, None
+        self.history = {'fstar': self.history['fstar']} if self.history is not None else None
 
     def compute_sv(self):
         """Function to be called after solving the deflected subgradient algorithm, computes the SV given the final lagrangian values
@@ -118,10 +209,11 @@ class SVR:
             mask = np.logical_or(self.beta == np.max(self.beta), self.beta == np.min(self.beta))
 
         support = np.vstack(np.vstack(np.arange(len(self.beta)))[mask]) # get array only of support vectors indexes
-        x_mask = np.repeat(mask, self.xs.shape[1], axis=1)
-        self.sv = self.xs[x_mask].reshape(-1,self.xs.shape[1]) # get array of support vectors
+        self.sv_indexes = np.ravel(support) # keep support vectors indexes wrt training data
+        self.sv = self.xs[self.sv_indexes] # get array of support vectors (row indexing works also for sparse input)
         y_sv = np.vstack(self.ys.reshape(-1,1)[mask]) # mask out the output values relative to support vectors
         self.betasv = np.vstack(self.beta[mask])
+        self.sv_tree = None # support vectors changed, index has to be rebuilt
         self.intercept = 0
         # the following operation is possible with any support vector, averaging gives more robustness
         for i in range(self.betasv.size):
@@ -135,29 +227,103 @@ class SVR:
         """Function to output model prediction on given data 'x'
 
         Args:
-            x (np.array): input data
+            x (np.array): input data, either dense or a sparse (scipy CSR) row
 
         Returns:
             np.array: output data
         """        
-        x = np.array([x]) # x is test input
+        x = x if kernel.issparse(x) else np.array([x]) # x is test input (sparse input is already a row matrix)
         if self.kernel == 'linear':
             # linear prediction is treated differently
-            prediction = np.dot(self.W, x.T) + self.intercept
+            prediction = np.asarray(x.dot(self.W.T)).T + self.intercept
             return prediction
 
-        gamma = self.gamma_value
+        if self.kernel == 'rbf' and self.sv_tree is not None:
+            return self._predict_fast(x)
 
         # predict accordingly to the kernel
-        if self.kernel == 'rbf':
-            K, _ = kernel.rbf(self.sv, x, gamma)
-        elif self.kernel == 'poly':
-            K, _ = kernel.poly(self.sv, x, gamma, self.degree, self.coef)
-        elif self.kernel == 'sigmoid':
-            K, _ = kernel.sigmoid(self.sv, x, gamma, self.coef)
+        K = kernel.get_cross_kernel(self, self.sv, x)
         prediction = np.dot(self.betasv.T, K) + self.intercept
         return prediction
 
+    def build_fast_predict(self, tol=1e-8, leafsize=16):
+        """Function to enable fast approximate prediction for the 'rbf' kernel: support vectors are indexed in a KD-tree
+        and only the ones within radius r from the query are summed up. Radius is chosen so that
+        exp(-gamma*r^2)*sum(|betasv|) <= tol, therefore every prediction differs from the exact one by at most tol
+
+        Args:
+            tol (float, optional): maximum absolute error allowed on each prediction. Defaults to 1e-8.
+            leafsize (int, optional): number of points at which the tree switches to brute force. Defaults to 16.
+        """
+        if self.kernel != 'rbf':
+            raise ValueError("Fast prediction is available only for the 'rbf' kernel")
+        if kernel.issparse(self.sv):
+            raise ValueError("Fast prediction needs dense support vectors, KD-tree does not index sparse data")
+        from scipy.spatial import cKDTree # only needed for fast prediction
+
+        beta_mass = np.sum(np.abs(self.betasv))
+        # contributions of the support vectors outside the radius sum up to at most tol
+        self.sv_radius = math.sqrt(math.log(beta_mass / tol) / self.gamma_value) if beta_mass > tol else 0.0
+        self.sv_tree = cKDTree(self.sv, leafsize=leafsize)
+        self.fast_predict_tol = tol
+
+    def _predict_fast(self, x):
+        """Function to output model prediction summing only the support vectors close to each input (see 'build_fast_predict')
+
+        Args:
+            x (np.array): input data
+
+        Returns:
+            np.array: output data
+        """
+        prediction = np.zeros((1, x.shape[0]))
+        for i, neighbors in enumerate(self.sv_tree.query_ball_point(x, self.sv_radius)):
+            if len(neighbors) > 0:
+                sq_dist = np.sum((self.sv[neighbors] - x[i])**2, axis=1)
+                prediction[0, i] = np.dot(self.betasv[neighbors, 0], np.exp(-self.gamma_value * sq_dist))
+        return prediction + self.intercept
+
+    def compress(self, val_x, tol, max_sv=None):
+        """Function to approximate the fitted model with a smaller set of expansion vectors (reduced-set method).
+        Support vectors are greedily selected (orthogonal matching pursuit on the predictions over 'val_x' and the support vectors themselves,
+        the latter keeping the approximation faithful on the whole training region) and at each step their coefficients are refitted
+        by least squares, until predictions differ from the original ones by at most tol
+
+        Args:
+            val_x (np.array): validation input data, on which the approximation error is measured
+            tol (float): maximum absolute difference allowed between original and compressed predictions (on 'val_x' and support vectors)
+            max_sv (int, optional): maximum number of expansion vectors to keep. Defaults to None (all the support vectors).
+
+        Returns:
+            SVR: compressed model (without training-time state), usable as a drop-in replacement for prediction.
+                If the original predictions are already within tol from the intercept, the expansion is empty (only the intercept is kept)
+        """
+        if self.kernel == 'linear':
+            raise ValueError("Linear kernel predicts through W, compression is not needed")
+        K = kernel.get_cross_kernel(self, self.sv, np.vstack([val_x, self.sv])) # one row per support vector
+        target = np.dot(self.betasv.T, K).ravel() # original predictions, without intercept
+        max_sv = len(self.betasv) if max_sv is None else min(max_sv, len(self.betasv))
+        norms = np.linalg.norm(K, axis=1)
+        norms[norms == 0] = 1
+
+        selected = []
+        coefs = np.zeros(0, dtype=self.dtype)
+        residual = target.copy()
+        while np.max(np.abs(residual)) > tol and len(selected) < max_sv:
+            correlation = np.abs(K.dot(residual)) / norms
+            correlation[selected] = -1 # never select twice the same vector
+            selected.append(int(np.argmax(correlation)))
+            coefs = np.linalg.lstsq(K[selected].T, target, rcond=None)[0] # refit all coefficients
+            residual = target - K[selected].T.dot(coefs)
+
+        compressed = copy.copy(self)
+        compressed.drop_train_state() # betas of the training patterns do not describe the compressed model anymore
+        compressed.sv = self.sv[selected]
+        compressed.betasv = coefs.reshape(-1, 1) # (0, 1) when no vector was needed
+        compressed.sv_indexes = self.sv_indexes[selected]
+        compressed.sv_tree = None
+        return compressed
+
     def eps_ins_loss(self, y, y_pred):
         """Function to calculate loss value given ground truth and predicted output
 
@@ -171,4 +337,116 @@ class SVR:
         loss = 0
         for i in range(len(y)):
             loss += (abs(y[i]-y_pred[i]) - self.eps)**2 if abs(y[i]-y_pred[i]) > self.eps else 0
-        return loss
\ No newline at end of file
+        return loss
+
+    def save(self, path, mmap=False):
+        """Function to save the fitted model in compact form (support vectors, their betas, intercept and kernel parameters)
+
+        Args:
+            path (string or file): destination '.npz' file
+            mmap (bool, optional): if True then support vectors and their betas are saved in separate '.npy' files next to 'path',
+                so that they can be memory-mapped by 'load'. Defaults to False.
+        """
+        _save_state(path, self._compact_state(), mmap)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Function to load a model saved with 'save', ready for prediction
+
+        Args:
+            path (string or file): '.npz' file written by 'save'
+            mmap_mode (string, optional): numpy memory-map mode (e.g. 'r') for support vectors saved with 'mmap=True'. Defaults to None.
+
+        Returns:
+            SVR: loaded model
+        """
+        return cls._from_compact_state(_load_state(path, mmap_mode))
+
+    def _compact_state(self, prefix=''):
+        """Function to collect the arrays describing a fitted model, without any training-time state
+
+        Args:
+            prefix (str, optional): string prepended to every key. Defaults to ''.
+
+        Returns:
+            dict: arrays needed to rebuild the model
+        """
+        state = {'kernel': np.array(self.kernel), 'gamma_value': np.array(np.nan if self.gamma_value is None else self.gamma_value),
+                 'degree': np.array(self.degree), 'coef': np.array(self.coef), 'box': np.array(self.box), 'eps': np.array(self.eps), 'dtype': np.array(self.dtype.name),
+                 'optim_args': np.array(json.dumps({k: float(v) for k, v in self.optim_args.items()})),
+                 'status': np.array(self.status), 'fstar': np.array(self.history['fstar'] if self.history is not None else np.nan),
+                 'betasv': self.betasv, 'sv_indexes': self.sv_indexes, 'intercept': np.array(self.intercept)}
+        if kernel.issparse(self.sv): # sparse support vectors are saved as their CSR components
+            sv = self.sv.tocsr()
+            state.update({'sv_data': sv.data, 'sv_indices': sv.indices, 'sv_indptr': sv.indptr, 'sv_shape': np.array(sv.shape)})
+        else:
+            state['sv'] = self.sv
+        if self.kernel == 'linear':
+            state['W'] = self.W
+        return {prefix + key: value for key, value in state.items()}
+
+    @classmethod
+    def _from_compact_state(cls, state, prefix=''):
+        """Function to rebuild a model from the arrays created by '_compact_state'
+
+        Args:
+            state (dict): arrays describing the model
+            prefix (str, optional): string prepended to every key. Defaults to ''.
+
+        Returns:
+            SVR: rebuilt model
+        """
+        kernel_name = str(state[prefix + 'kernel'])
+        gamma_value = None if kernel_name == 'linear' else float(state[prefix + 'gamma_value'])
+        model = cls(kernel_name, {'gamma': gamma_value, 'degree': state[prefix + 'degree'].item(), 'coef': state[prefix + 'coef'].item()},
+                    box=float(state[prefix + 'box']), eps=float(state[prefix + 'eps']), dtype=str(state.get(prefix + 'dtype', 'float64')))
+        model.gamma_value = gamma_value
+        model.optim_args = json.loads(str(state[prefix + 'optim_args']))
+        model.status = str(state[prefix + 'status'])
+        model.history = {'fstar': float(state[prefix + 'fstar'])}
+        model.xs, model.ys, model.K, model.beta = None, None, None, None
+        if prefix + 'sv_indptr' in state:
+            model.sv = kernel.sparse.csr_matrix((state[prefix + 'sv_data'], state[prefix + 'sv_indices'], state[prefix + 'sv_indptr']), shape=tuple(state[prefix + 'sv_shape']))
+        else:
+            model.sv = state[prefix + 'sv']
+        model.betasv, model.sv_indexes = state[prefix + 'betasv'], state[prefix + 'sv_indexes']
+        model.intercept = state[prefix + 'intercept']
+        if kernel_name == 'linear':
+            model.W = state[prefix + 'W']
+        return model
+
+def _save_state(path, state, mmap=False):
+    """Save a dictionary of arrays into a '.npz' file, optionally keeping the 2D arrays in separate memory-mappable '.npy' files
+
+    Args:
+        path (string or file): destination '.npz' file
+        state (dict): arrays to save
+        mmap (bool, optional): if True then 2D arrays are saved as '<path>.<key>.npy'. Defaults to False.
+    """
+    if mmap and isinstance(path, str):
+        base = path[:-4] if path.endswith('.npz') else path
+        mmap_keys = [key for key, value in state.items() if np.ndim(value) == 2]
+        for key in mmap_keys:
+            np.save(f"{base}.{key}.npy", state[key])
+        state = {key: value for key, value in state.items() if key not in mmap_keys}
+        state['mmap_keys'] = np.array(mmap_keys)
+        path = base + '.npz'
+    np.savez(path, **state)
+
+def _load_state(path, mmap_mode=None):
+    """Load a dictionary of arrays saved by '_save_state'
+
+    Args:
+        path (string or file): '.npz' file
+        mmap_mode (string, optional): numpy memory-map mode for arrays saved in separate '.npy' files. Defaults to None.
+
+    Returns:
+        dict: loaded arrays
+    """
+    with np.load(path) as data:
+        state = {key: data[key] for key in data.files}
+    if 'mmap_keys' in state:
+        base = path[:-4] if path.endswith('.npz') else path
+        for key in state.pop('mmap_keys'):
+            state[str(key)] = np.load(f"{base}.{key}.npy", mmap_mode=mmap_mode)
+    return state
\ No newline at end of file
@@ -0,0 +1,173 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import kernel as k
+from SVR import SVR
+from kp import solveKP
+from deflected_subgradient import projectDirection, solveDeflected, SolverProfiler
+
+def make_cup_like(n, n_features=10, seed=0):
+    """Function to generate a synthetic dataset shaped like ML-CUP20 (10 inputs in [-1, 1] and 2 smooth nonlinear outputs on the CUP scale)
+
+    Args:
+        n (int): number of patterns
+        n_features (int, optional): number of inputs. Defaults to 10.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        (np.array, np.array): inputs (n x n_features) and outputs (n x 2)
+    """
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(-1, 1, (n, n_features))
+    w1, w2 = rng.normal(size=n_features), rng.normal(size=n_features)
+    y1 = 50 + 20*np.tanh(x.dot(w1)) + 5*np.sin(3*x[:, 0]) + rng.normal(0, 1, n)
+    y2 = -30 + 10*np.tanh(x.dot(w2)) + 5*np.cos(3*x[:, 1]) + rng.normal(0, 1, n)
+    return x, np.column_stack([y1, y2])
+
+def _best_time(function, repeat):
+    """Function to time 'function', best of 'repeat' runs (least disturbed by other processes)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def _peak_memory(function):
+    """Function to measure the peak memory allocated while running 'function' (python and numpy allocations), in bytes.
+    It is measured on a separate run, since tracing slows down pure python code
+    """
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def bench_size(n, kernel_name='rbf', iterations=20, repeat=3, n_queries=200, seed=0):
+    """Function to benchmark every CM component on a problem of size n
+
+    Args:
+        n (int): number of training patterns
+        kernel_name (string, optional): kernel used for kernel, solver and prediction benchmarks. Defaults to 'rbf'.
+        iterations (int, optional): number of solver iterations. Defaults to 20.
+        repeat (int, optional): timings are the best of 'repeat' runs. Defaults to 3.
+        n_queries (int, optional): number of single pattern predictions. Defaults to 200.
+        seed (int, optional): random seed of the synthetic data. Defaults to 0.
+
+    Returns:
+        list: one dictionary of results per component
+    """
+    x, y = make_cup_like(n, seed=seed)
+    y = y[:, 0]
+    box = 1.0
+    rng = np.random.RandomState(seed)
+    results = []
+
+    def add(component, elapsed, work, unit, peak, **extra):
+        results.append({'component': component, 'n': n, 'time': elapsed, 'throughput': work / elapsed, 'unit': unit, 'peak_memory': peak, **extra})
+
+    # kernel matrix
+    model = SVR(kernel_name, {'gamma': 'scale'}, box=box)
+    model.xs = x
+    get_kernel = lambda: k.get_kernel(model)
+    add('get_kernel', _best_time(get_kernel, repeat), n*n, 'entries/s', _peak_memory(get_kernel))
+    K, gamma_value = get_kernel()
+
+    # knapsack projection
+    betas = np.vstack(rng.uniform(-2*box, 2*box, n))
+    solve_kp = lambda: solveKP(box, 0, betas, False)
+    add('solveKP', _best_time(solve_kp, repeat), n, 'variables/s', _peak_memory(solve_kp))
+
+    # direction projection (works in place, so it gets a fresh direction every run)
+    beta = solveKP(box, 0, betas, False)
+    direction = rng.normal(size=(n, 1))
+    project = lambda: projectDirection(beta, direction.copy(), box)
+    add('projectDirection', _best_time(project, repeat), n, 'variables/s', _peak_memory(project))
+
+    # solver iterations, split into components by the profiler
+    optim_args = {'vareps': 0.1, 'maxiter': iterations, 'eps': 1e-2}
+    beta_init = np.vstack(np.zeros(n))
+    solve = lambda profiler=None: solveDeflected(beta_init, y, K, box, optim_args, -np.inf, 1e-12, callback=profiler)
+    elapsed = _best_time(solve, repeat)
+    profiler = SolverProfiler(keep_samples=False)
+    solve(profiler)
+    summary = profiler.summary()
+    add('solveDeflected', elapsed, summary['iterations'], 'iterations/s', _peak_memory(solve),
+        time_per_iteration=elapsed / summary['iterations'], **{key: value for key, value in summary.items() if key.startswith('share_')})
+
+    # single pattern prediction
+    model = SVR(kernel_name, {'gamma': 'scale'}, box=box)
+    model.fit(x, y, optim_args, precomp_kernel=[K, gamma_value], optim_verbose=False, fit_time=False, keep_train_state=False)
+    queries = x[rng.randint(0, n, n_queries)]
+    predict = lambda: [model.predict(query) for query in queries]
+    add('SVR.predict', _best_time(predict, repeat), n_queries, 'predictions/s', _peak_memory(predict), n_sv=len(model.betasv))
+    return results
+
+def bench_precision(x, y, iterations=1000, gamma=0.1, box=1.0, eps=0.1):
+    """Function to compare float64 and float32 working precision (see SVR 'dtype') fitting the same rbf model on (x, y)
+
+    Args:
+        x (np.array): training inputs
+        y (np.array): training outputs (one output)
+        iterations (int, optional): solver iterations. Defaults to 1000.
+        gamma (float, optional): rbf kernel gamma. Defaults to 0.1.
+        box (float, optional): model 'C' parameter. Defaults to 1.0.
+        eps (float, optional): epsilon-tube width. Defaults to 0.1.
+
+    Returns:
+        list: one dictionary of results per dtype, the float32 one also reports its differences from float64
+    """
+    results, predictions = [], []
+    for dtype in [np.float64, np.float32]:
+        model = SVR('rbf', {'gamma': gamma}, box=box, eps=eps, dtype=dtype)
+        profiler = SolverProfiler(keep_samples=False)
+        model.fit(x, y, {'maxiter': iterations}, optim_verbose=False, fit_time=False, optim_callback=profiler)
+        summary = profiler.summary()
+        predictions.append(np.array([np.ravel(model.predict(pattern))[0] for pattern in x], dtype=np.float64))
+        results.append({'component': 'precision', 'dtype': np.dtype(dtype).name, 'n': len(x), 'iterations': summary['iterations'], 'status': model.status,
+                        'kernel_bytes': model.K.nbytes, 'matvec_per_iteration': summary['time_matvec'] / summary['iterations'],
+                        'time_per_iteration': summary['time_per_iteration'], 'f_best': float(model.history['fstar']),
+                        'mee': float(np.mean(np.abs(y - predictions[-1])))})
+    for result, prediction in zip(results, predictions):
+        result['f_best_relative_difference'] = abs(result['f_best'] - results[0]['f_best']) / abs(results[0]['f_best'])
+        result['max_prediction_difference'] = float(np.max(np.abs(prediction - predictions[0])))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark CM components (kernel, knapsack, projection, solver, prediction) over problem sizes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 4000], help="numbers of training patterns")
+    parser.add_argument('--kernel', default='rbf', choices=['linear', 'rbf', 'poly', 'sigmoid'])
+    parser.add_argument('--iterations', type=int, default=20, help="solver iterations per run")
+    parser.add_argument('--repeat', type=int, default=3, help="timings are the best of this many runs")
+    parser.add_argument('--queries', type=int, default=200, help="number of single pattern predictions")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='benchmark_results.json', help="machine readable output file")
+    parser.add_argument('--precision', action='store_true', help="compare float64 and float32 fits on the ML-CUP training set (first output) instead")
+    args = parser.parse_args()
+
+    results = []
+    if args.precision:
+        import get_cup_dataset as dt # only needed for the precision comparison
+        x, y = dt._get_cup('train')
+        print(f"(BENCH) - float64 vs float32, n = {len(x)}, {args.iterations} iterations")
+        for result in bench_precision(x, y[:, 0], args.iterations):
+            print(f"\t{result['dtype']:<8} kernel {result['kernel_bytes']/1e6:.1f} MB - matvec {result['matvec_per_iteration']*1e3:.2f} ms/iter - {result['time_per_iteration']*1e3:.2f} ms/iter"
+                  f" - f_best {result['f_best']:.5f} (rel. diff {result['f_best_relative_difference']:.1e}) - MEE {result['mee']:.6f} - max pred. diff {result['max_prediction_difference']:.1e}")
+            results.append(result)
+    for n in ([] if args.precision else args.sizes):
+        print(f"(BENCH) - n = {n}")
+        for result in bench_size(n, args.kernel, args.iterations, args.repeat, args.queries, args.seed):
+            print(f"\t{result['component']:<17} time {result['time']:.6f}s - {result['throughput']:.4g} {result['unit']} - peak memory {result['peak_memory']/2**20:.2f} MB")
+            results.append(result)
+
+    output = {'meta': {'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+                       'processor': platform.processor(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'args': vars(args)},
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"(BENCH) - Results saved to {args.out}")
@@ -2,6 +2,7 @@ from kp import solveKP
 import numpy as np
 import copy
 import math
+import time
 
 def unrollArgs(optim_args):
     """Extract all optimization arguments or set them to default value
@@ -29,19 +30,101 @@ def projectDirection(x, d, box, eps=1e-10):
     Args:
         x (np.array): list of current values of variables
         d (np.array): gradient
-        box (float): box constraint (C)
+        box (float or np.array): box constraint (C), one per column if x has many columns
         eps (float, optional): projection threshold. Defaults to 1e-10.
 
     Returns:
         np.array: projected gradient
     """
     # to avoid reaching a set of coordinates out of the constrained box
-    for i in range(len(d)):
-        if (abs(-box-x[i]) < eps and d[i] < 0) or (box - x[i] < eps and d[i] > 0):
-            d[i] = 0 # zero out the direction dims leading out of constrained box
+    out_of_box = np.logical_or(np.logical_and(np.abs(-box-x) < eps, d < 0), np.logical_and(box - x < eps, d > 0))
+    d[out_of_box] = 0 # zero out the direction dims leading out of constrained box
     return d
 
-def solveDeflected(x, y, K, box, optim_args, target_func_value, max_error_target_func_value, return_history=True, verbose=False):
+class HistoryBuffer:
+    """
+    Preallocated buffer for the function values of an optimization process. Values can be recorded once every 'stride'
+    iterations and, if 'cap' is given, only the last 'cap' recorded values are kept (ring buffer).
+    The iteration number of every recorded value is kept next to it, so that consecutive values are not mistaken for consecutive iterations
+    """
+    def __init__(self, maxiter, stride=1, cap=None):
+        """Allocate the buffer
+
+        Args:
+            maxiter (float): maximum number of iterations of the optimization process
+            stride (int, optional): one value every 'stride' iterations is recorded. Defaults to 1.
+            cap (int, optional): maximum number of values kept, older ones are overwritten. Defaults to None (all values are kept).
+        """
+        self.stride = stride
+        self.cap = cap
+        self.values = np.empty(cap if cap is not None else int(maxiter) // stride + 1)
+        self.iterations = np.empty(self.values.size, dtype=np.int64)
+        self.count = 0 # number of recorded values
+
+    def record(self, i, value):
+        """Record the function value of iteration i, if it falls on the stride
+
+        Args:
+            i (int): iteration count
+            value (float): function value
+        """
+        if i % self.stride == 0:
+            self.values[self.count % self.values.size] = value
+            self.iterations[self.count % self.values.size] = i
+            self.count += 1
+
+    def _ordered(self, buffer):
+        if self.count <= buffer.size:
+            return buffer[:self.count].copy()
+        return np.roll(buffer, -(self.count % buffer.size)) # ring buffer has wrapped around
+
+    def to_array(self):
+        """Get the recorded values, oldest first
+
+        Returns:
+            np.array: recorded function values
+        """
+        return self._ordered(self.values)
+
+    def iterations_to_array(self):
+        """Get the iteration numbers of the recorded values, oldest first
+
+        Returns:
+            np.array: iteration numbers
+        """
+        return self._ordered(self.iterations)
+
+def historyIterations(history):
+    """Get the iteration numbers of the function values of an optimization history
+
+    Args:
+        history (dict): history returned by solveDeflected or solveDeflectedMulti
+
+    Returns:
+        np.array: iteration number of every value of history['f'] (histories saved without them were recorded every 'stride' iterations from 0)
+    """
+    if 'it' in history:
+        return np.asarray(history['it'])
+    return np.arange(len(history['f'])) * history.get('stride', 1)
+
+def convergenceRate(f, iterations, fstar):
+    """Compute the per-iteration convergence rate between consecutive recorded function values.
+    Values k and k+1 are it[k+1]-it[k] iterations apart, so the rate is ((f[k+1]-fstar)/(f[k]-fstar))^(1/(it[k+1]-it[k]))
+
+    Args:
+        f (np.array): recorded function values
+        iterations (np.array): iteration number of every value (see historyIterations)
+        fstar (float): optimal (or best) function value
+
+    Returns:
+        np.array: convergence rate of every interval between two recorded values
+    """
+    f, iterations = np.asarray(f, dtype=float), np.asarray(iterations)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (f[1:] - fstar) / (f[:-1] - fstar)
+        return np.sign(ratio) * np.abs(ratio) ** (1 / np.diff(iterations)) # sign kept for values below a given fstar
+
+def solveDeflected(x, y, K, box, optim_args, target_func_value, max_error_target_func_value, return_history=True, verbose=False, callback=None, callback_stride=1, history_stride=1, history_cap=None):
     """Compute deflected subgradient algorithm
 
     Args:
@@ -54,46 +137,55 @@ def solveDeflected(x, y, K, box, optim_args, target_func_value, max_error_target
         max_error_target_func_value (float): relative error wrt target_func_value to get 'acceptable' solution
         return_history (bool, optional): return dict with history of optimization procedure. Defaults to True.
         verbose (bool, optional): verbose output. Defaults to False.
+        callback (callable, optional): called every 'callback_stride' iterations with a dict of iteration statistics
+            (i, v, fref, norm_g, delta, nu and cumulative time spent in matvec, projection, kp and overall), and once more at the end
+            with the exit status (see SolverProfiler). Defaults to None.
+        callback_stride (int, optional): number of iterations between two callback calls. Defaults to 1.
+        history_stride (int, optional): one function value every 'history_stride' iterations is kept in history. Defaults to 1.
+        history_cap (int, optional): maximum number of function values kept in history (the last ones). Defaults to None.
 
     Returns:
         np.array: optimal betas
         str: exit status of optimization algorithm
-        dict: (optinal) history of optimization process
+        dict: (optinal) history of optimization process, 'f' being a np.array
     """
     vareps, maxiter, deltares, rho, eps, alpha, psi = unrollArgs(optim_args) # get all parameters needed for the algorithm
     xref = copy.deepcopy(x) # set reference point
     fref = math.inf # set reference function value
     delta = 0 # initial value for vanishing threshold parameter
-    dprev = np.zeros((x.size,1)) # previous direction needed for deflection
+    dprev = np.zeros((x.size,1), dtype=x.dtype) # previous direction needed for deflection
     i = 0 # iteration count
     prevnormg = math.inf # gradient norm at previous step
-    history = {'f': []} # dictionary needed for plotting after computation
+    y = np.asarray(y, dtype=x.dtype) # working precision is the one of the betas (float32 or float64)
+    f_history = HistoryBuffer(maxiter, history_stride, history_cap) # function values needed for plotting after computation
+    timings = {'time_matvec': 0.0, 'time_projection': 0.0, 'time_kp': 0.0, 'time_total': 0.0} # cumulative time spent in each phase
     while True:
+        start = time.perf_counter()
         if abs(fref - target_func_value) <= max_error_target_func_value:
             # acceptable condition reached
-            if return_history:
-                history['fstar'] = fref # save minimum function value
-                return xref, 'acceptable', history
-            return xref, 'acceptable', None
+            status, x, fstar = 'acceptable', xref, fref
+            timings['time_total'] += time.perf_counter() - start # every exit path is counted in the total
+            break
         if i > maxiter:
             # stopped condition reached
-            if return_history:
-                history['fstar'] = fref # save minimum function value
-                return xref, 'stopped', history
-            return xref, 'stopped', None
-        v = (0.5 * np.dot(np.dot(np.transpose(x), K), x) 
-            + vareps * np.sum(np.abs(x))
-            - np.transpose(y).dot(x))[0,0] # would return a matrix otherwise
+            status, x, fstar = 'stopped', xref, fref
+            timings['time_total'] += time.perf_counter() - start
+            break
+        # objective value is always accumulated in float64
+        x64 = x.astype(np.float64, copy=False)
+        v = (0.5 * np.dot(np.dot(np.transpose(x), K).astype(np.float64, copy=False), x64)
+            + vareps * np.sum(np.abs(x64))
+            - np.transpose(y).astype(np.float64, copy=False).dot(x64))[0,0] # would return a matrix otherwise
         g = K.dot(x) + vareps*np.sign(x) - y.reshape(-1,1) # reshape to transform y from horizontal to vertical array
-        norm_g = np.linalg.norm(g) # get norm of descent direction gradient
+        timings['time_matvec'] += time.perf_counter() - start
+        norm_g = np.linalg.norm(g.astype(np.float64, copy=False)) # get norm of descent direction gradient
         if verbose: print("i: {:4d} - v: {:4f} - fref: {:4f} - ||g||: {:4f} - delta: {:e} - ||gdiff||: {:4f} - eps: {:e}".format(i, v, fref, norm_g, delta, prevnormg-norm_g, eps))
         prevnormg = norm_g
         if norm_g < 1e-10:
             # optimal condition reached
-            if return_history:
-                history['fstar'] = v
-                return x, 'optimal', history
-            return x, 'optimal', None
+            status, fstar = 'optimal', v
+            timings['time_total'] += time.perf_counter() - start # time_matvec of this iteration is already counted
+            break
         # reset delta if v is good or decrease it otherwise
         if v <= fref - delta:
             delta = deltares * max(abs(v),1)
@@ -104,10 +196,181 @@ def solveDeflected(x, y, K, box, optim_args, target_func_value, max_error_target
             fref = copy.deepcopy(v)
             xref = copy.deepcopy(x)
         d = alpha*g + (1-alpha)*dprev # get deflected direction
+        phase_start = time.perf_counter()
         dproj = projectDirection(x, d, box) # constrain direction accordingly
+        timings['time_projection'] += time.perf_counter() - phase_start
         dprev = dproj 
-        nu = psi*(v-fref+delta)/(np.linalg.norm(dproj)**2) # get stepsize following Target Value
-        x = x - nu*dproj # get new point coordinates
+        nu = psi*(v-fref+delta)/(np.linalg.norm(dproj.astype(np.float64, copy=False))**2) # get stepsize following Target Value
+        x = x - x.dtype.type(nu)*dproj # get new point coordinates (keeping working precision)
+        phase_start = time.perf_counter()
         x = solveKP(box, 0, x, False) # project new point to follow constraints
+        timings['time_kp'] += time.perf_counter() - phase_start
+        timings['time_total'] += time.perf_counter() - start
+        if callback is not None and i % callback_stride == 0:
+            callback({'i': i, 'v': v, 'fref': fref, 'norm_g': norm_g, 'delta': delta, 'nu': nu, **timings})
+        f_history.record(i, v)
+        i += 1 # next iteration
+    if callback is not None:
+        callback({'i': i, 'fref': fstar, 'status': status, **timings}) # final statistics
+    if return_history:
+        # save function values and minimum function value
+        return x, status, {'f': f_history.to_array(), 'it': f_history.iterations_to_array(), 'fstar': fstar, 'stride': history_stride}
+    return x, status, None
+
+class SolverProfiler:
+    """
+    Callback for solveDeflected collecting the sampled iteration statistics and producing a timing breakdown of the fit
+    """
+    def __init__(self, keep_samples=True):
+        """Initialize an empty profiler
+
+        Args:
+            keep_samples (bool, optional): if True then every sampled statistics dict is stored in 'samples'. Defaults to True.
+        """
+        self.keep_samples = keep_samples
+        self.samples = []
+        self.last = None
+
+    def __call__(self, stats):
+        """Receive the statistics of a sampled iteration
+
+        Args:
+            stats (dict): iteration statistics given by solveDeflected
+        """
+        if self.keep_samples:
+            self.samples.append(stats)
+        self.last = stats
+
+    def summary(self):
+        """Compute the timing breakdown of the fit, from the last received statistics
+
+        Returns:
+            dict: iterations, exit status, seconds spent in each phase, their share of the total time and time per iteration
+        """
+        if self.last is None:
+            return {}
+        total = self.last['time_total']
+        breakdown = {'iterations': self.last['i'], 'status': self.last.get('status'), 'time_total': total}
+        other = total
+        for phase in ['matvec', 'projection', 'kp']:
+            breakdown['time_'+phase] = self.last['time_'+phase]
+            breakdown['share_'+phase] = self.last['time_'+phase] / total if total > 0 else 0
+            other -= self.last['time_'+phase]
+        breakdown['time_other'] = other
+        breakdown['share_other'] = other / total if total > 0 else 0
+        breakdown['time_per_iteration'] = total / max(self.last['i'], 1)
+        return breakdown
+
+    def __str__(self):
+        """Function to print out the timing breakdown
+
+        Returns:
+            string: timing breakdown
+        """
+        breakdown = self.summary()
+        if not breakdown:
+            return "No statistics received"
+        profile_as_string = f"Iterations: {breakdown['iterations']} - Status: {breakdown['status']} - Total time: {breakdown['time_total']:.4f}s ({breakdown['time_per_iteration']*1e3:.4f}ms/iter)"
+        for phase in ['matvec', 'projection', 'kp', 'other']:
+            profile_as_string += f"\n\t{phase}: {breakdown['time_'+phase]:.4f}s ({100*breakdown['share_'+phase]:.1f}%)"
+        return profile_as_string
+
+def solveDeflectedMulti(X, Y, K, box, optim_args, target_func_value, max_error_target_func_value, return_history=True, verbose=False, history_stride=1, history_cap=None):
+    """Compute deflected subgradient algorithm for many outputs sharing the same kernel.
+    Each column follows exactly the same steps as solveDeflected would do on it, but the kernel products
+    of all the running columns are computed with a single K @ X per iteration.
+
+    Args:
+        X (np.array): initial betas, one column per output
+        Y (np.array): output matrix, one column per output
+        K (np.array): kernel matrix (shared by all outputs)
+        box (float or list): box constraint (C), either shared or one per output
+        optim_args (dict or list): dictionary with optimization parameters, either shared or one per output
+        target_func_value (float or list): optimal value used as goal for the 'acceptable' scenario, either shared or one per output
+        max_error_target_func_value (float or list): relative error wrt target_func_value to get 'acceptable' solution, either shared or one per output
+        return_history (bool, optional): return list of dicts with history of optimization procedure. Defaults to True.
+        verbose (bool, optional): verbose output. Defaults to False.
+        history_stride (int, optional): one function value every 'history_stride' iterations is kept in history. Defaults to 1.
+        history_cap (int, optional): maximum number of function values kept in history (the last ones). Defaults to None.
+
+    Returns:
+        np.array: optimal betas, one column per output
+        list: exit status of optimization algorithm for each output
+        list: (optinal) history of optimization process for each output
+    """
+    n_out = X.shape[1]
+    optim_args = [optim_args]*n_out if isinstance(optim_args, dict) else optim_args
+    # every algorithmic parameter becomes a vector with one value per output
+    vareps, maxiter, deltares, rho, eps, alpha, psi = np.array([unrollArgs(args) for args in optim_args], dtype=float).T
+    box = np.broadcast_to(np.asarray(box, dtype=float), (n_out,))
+    target_func_value = np.broadcast_to(np.asarray(target_func_value, dtype=float), (n_out,))
+    max_error_target_func_value = np.broadcast_to(np.asarray(max_error_target_func_value, dtype=float), (n_out,))
+    Y = np.asarray(Y).reshape(-1, n_out)
+
+    X = np.array(X, dtype=float) # current points, columns of finished outputs are not touched anymore
+    Xref = copy.deepcopy(X) # set reference points
+    Xbest = np.zeros(X.shape) # returned betas
+    fref = np.full(n_out, math.inf) # set reference function values
+    delta = np.zeros(n_out) # initial values for vanishing threshold parameter
+    Dprev = np.zeros(X.shape) # previous directions needed for deflection
+    status = [None]*n_out
+    history = [{'stride': history_stride} for _ in range(n_out)] # dictionaries needed for plotting after computation
+    f_history = [HistoryBuffer(maxiter[j], history_stride, history_cap) for j in range(n_out)]
+    active = np.arange(n_out) # outputs still being optimized
+    i = 0 # iteration count
+    while True:
+        # acceptable or stopped condition reached (checked separately for each output)
+        accepted = np.abs(fref[active] - target_func_value[active]) <= max_error_target_func_value[active]
+        stopped = i > maxiter[active]
+        for j in active[np.logical_or(accepted, stopped)]:
+            Xbest[:, j] = Xref[:, j]
+            status[j] = 'acceptable' if abs(fref[j] - target_func_value[j]) <= max_error_target_func_value[j] else 'stopped'
+            history[j]['fstar'] = fref[j] # save minimum function value
+        active = active[np.logical_not(np.logical_or(accepted, stopped))]
+        if active.size == 0:
+            break
+
+        Xa = X[:, active]
+        KX = K.dot(Xa) # single kernel product for all running outputs
+        v = (0.5 * np.sum(Xa * KX, axis=0)
+            + vareps[active] * np.sum(np.abs(Xa), axis=0)
+            - np.sum(Y[:, active] * Xa, axis=0))
+        G = KX + vareps[active]*np.sign(Xa) - Y[:, active]
+        norm_g = np.linalg.norm(G, axis=0) # get norm of descent direction gradients
+        if verbose:
+            for k, j in enumerate(active):
+                print("out: {:d} - i: {:4d} - v: {:4f} - fref: {:4f} - ||g||: {:4f} - delta: {:e} - eps: {:e}".format(j, i, v[k], fref[j], norm_g[k], delta[j], eps[j]))
+        optimal = norm_g < 1e-10
+        for k in np.flatnonzero(optimal):
+            # optimal condition reached
+            Xbest[:, active[k]] = Xa[:, k]
+            status[active[k]] = 'optimal'
+            history[active[k]]['fstar'] = v[k]
+        if np.any(optimal):
+            running = np.logical_not(optimal)
+            active, Xa, G, v = active[running], Xa[:, running], G[:, running], v[running]
+            if active.size == 0:
+                break
+        # reset delta if v is good or decrease it otherwise
+        delta[active] = np.where(v <= fref[active] - delta[active],
+                                 deltares[active] * np.maximum(np.abs(v), 1),
+                                 np.maximum(delta[active]*rho[active], eps[active]*np.maximum(np.abs(np.minimum(v, fref[active])), 1)))
+        # update fref and xref if needed
+        improved = v < fref[active]
+        fref[active[improved]] = v[improved]
+        Xref[:, active[improved]] = Xa[:, improved]
+        D = alpha[active]*G + (1-alpha[active])*Dprev[:, active] # get deflected directions
+        Dproj = projectDirection(Xa, D, box[active]) # constrain directions accordingly
+        Dprev[:, active] = Dproj
+        nu = psi[active]*(v-fref[active]+delta[active])/np.sum(Dproj**2, axis=0) # get stepsizes following Target Value
+        Xa = Xa - nu*Dproj # get new points coordinates
+        for k, j in enumerate(active):
+            X[:, j] = np.ravel(solveKP(box[j], 0, Xa[:, k], False)) # project new points to follow constraints
+            f_history[j].record(i, v[k])
         i += 1 # next iteration
-        history['f'].append(v)
\ No newline at end of file
+    if return_history:
+        for j in range(n_out):
+            history[j]['f'] = f_history[j].to_array()
+            history[j]['it'] = f_history[j].iterations_to_array()
+        return Xbest, status, history
+    return Xbest, status, None
@@ -3,8 +3,34 @@ import os
 import numpy as np
 import random
 
+def _cached_array(path, columns=slice(1, None), skip_rows=0, delimiter=',', dtype=np.float64):
+    """ Returns the csv file at 'path' as a contiguous array (only given 'columns', after 'skip_rows' header rows).
+        Parsed content is cached as '.npy' in a '.cache' folder next to the file, keyed by the file size and
+        modification time, so that the csv is parsed only once until it changes.
+    """
+    stat = os.stat(path)
+    cache_dir = os.path.join(os.path.dirname(path), '.cache')
+    prefix = os.path.basename(path) + '.'
+    cache_file = os.path.join(cache_dir, f"{prefix}{stat.st_size}.{stat.st_mtime_ns}.npy")
+    if os.path.exists(cache_file):
+        return np.load(cache_file, mmap_mode='r')
+
+    with open(path) as csv_file:
+        rows = list(csv.reader(csv_file, delimiter=delimiter))[skip_rows:]
+    data = np.array([row[columns] for row in rows], dtype=dtype)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_file in os.listdir(cache_dir): # drop caches of previous versions of the file
+        if old_file.startswith(prefix) and old_file.endswith('.npy'):
+            os.remove(os.path.join(cache_dir, old_file))
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp_file, cache_file) # atomic, concurrent readers never see a partial cache
+    return data
+
 # -------------------------------------------------------- MLCUP -------------------------------------------------------- #
-cup_path = os.path.dirname(os.path.abspath(__file__))[:-11] + '\\ml_cup\\ML-CUP20-'
+cup_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ml_cup', 'ML-CUP20-')
 
 def _get_cup(dataset_type='train'): # can either be 'train' or 'test'
     """ Both 'train' and 'test' set are composed of an initial index column (useless for the application),
@@ -15,24 +41,38 @@ def _get_cup(dataset_type='train'): # can either be 'train' or 'test'
         print('Arguments given are not acceptable!\nPossible datasets: train - test')
         return None, None
 
-    data_set = list()
-    data_label = list()
     path = cup_path + ("TR" if dataset_type == "train" else "TS") + ".csv"
-    with open(path) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        rows = [row for row in csv_reader]
-        if dataset_type == 'train': 
-            for row in rows[7:]:
-                float_row = [float(i) for i in row[1:]]
-                data_set.append(float_row[0:-2])
-                data_label.append(float_row[-2:])
-            seed = 123
-            random.Random(seed).shuffle(data_set)
-            random.Random(seed).shuffle(data_label)
-        else: # test data
-            for row in rows[7:]:
-                float_row = [float(i) for i in row[1:]]
-                data_set.append(float_row)
-            data_label = None
-    
-    return np.array(data_set), np.array(data_label)
\ No newline at end of file
+    rows = _cached_array(path, skip_rows=7)
+    if dataset_type == 'train':
+        # shuffling a list of indexes gives the same order as shuffling the lists of rows
+        seed = 123
+        indexes = list(range(rows.shape[0]))
+        random.Random(seed).shuffle(indexes)
+        rows = rows[indexes]
+        return np.ascontiguousarray(rows[:, :-2]), np.ascontiguousarray(rows[:, -2:])
+    # test data
+    return np.array(rows), np.array(None)
+
+def _iter_cup_chunks(source='test', chunk_size=1000):
+    """ Yields the input rows of 'source' in blocks of at most 'chunk_size' rows, so that arbitrarily large
+        sets are scored with bounded memory.
+        'source' can either be 'test' (ML-CUP blind test set), the path of a csv file in the same format
+        (comment lines starting with '#', then index column followed by the input columns)
+        or an array of inputs, e.g. np.load(..., mmap_mode='r'), which is sliced without being loaded whole.
+    """
+    if isinstance(source, str):
+        path = cup_path + "TS.csv" if source == 'test' else source
+        with open(path) as csv_file:
+            chunk = list()
+            for row in csv.reader(csv_file, delimiter=','):
+                if not row or row[0].startswith('#'):
+                    continue
+                chunk.append([float(i) for i in row[1:]])
+                if len(chunk) == chunk_size:
+                    yield np.array(chunk)
+                    chunk = list()
+            if chunk:
+                yield np.array(chunk)
+    else:
+        for start in range(0, source.shape[0], chunk_size):
+            yield np.asarray(source[start:start+chunk_size])
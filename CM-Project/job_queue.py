@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import numpy as np
+import kernel as k
+from SVR import SVR
+from results_store import ResultsStore, _json_default
+
+class JobQueue:
+    """
+    Class' objective is to share the configurations of a search among any number of worker processes, on one or several hosts
+    sharing a filesystem, through a local SQLite file:
+        'submit' to add jobs
+        'claim' to take the next job, most expensive first, preferring the kernel the worker already holds
+        'complete' / 'fail' to close a claimed job
+    Jobs claimed by a worker that did not close them within 'stale_after' seconds are given back to the other workers.
+    Please note that SQLite locking has to be supported by the shared filesystem (e.g. it is unreliable on some NFS setups).
+    """
+    COLUMNS = ['hash', 'search', 'params', 'kernel_key', 'cost', 'state', 'worker', 'claimed', 'error']
+
+    def __init__(self, path, stale_after=24*3600, timeout=60):
+        """Open (or create) the queue
+
+        Args:
+            path (string): SQLite database file
+            stale_after (float, optional): seconds after which a claimed job that is still running is considered lost. Defaults to 24*3600.
+            timeout (float, optional): seconds to wait for the database lock held by other workers. Defaults to 60.
+        """
+        self.path = path
+        self.stale_after = stale_after
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None) # transactions are handled explicitly
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                       hash TEXT PRIMARY KEY, search TEXT, params TEXT, kernel_key TEXT, cost REAL,
+                                       state TEXT, worker TEXT, claimed REAL, error TEXT)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state_cost ON jobs (state, cost)")
+
+    def submit(self, search, jobs):
+        """Function to add jobs to the queue, jobs already present (same hash) are left untouched
+
+        Args:
+            search (string): name of the search the jobs belong to
+            jobs (list): (hash, params, kernel_key, cost) tuples, with 'params' json serializable
+
+        Returns:
+            int: number of jobs actually added
+        """
+        rows = [(key, search, json.dumps(params, sort_keys=True, default=_json_default), kernel_key, float(cost), 'pending', None, None, None)
+                for key, params, kernel_key, cost in jobs]
+        self.connection.execute("BEGIN IMMEDIATE")
+        before = self.connection.total_changes
+        self.connection.executemany("INSERT OR IGNORE INTO jobs VALUES (?,?,?,?,?,?,?,?,?)", rows)
+        self.connection.execute("COMMIT")
+        return self.connection.total_changes - before
+
+    def claim(self, worker, kernel_key=None):
+        """Function to take the next job: among the pending ones the most expensive job computed on 'kernel_key'
+        is preferred (the worker does not have to compute its kernel again), otherwise the most expensive job overall,
+        so that long jobs do not end up alone at the end of the search
+
+        Args:
+            worker (string): worker identifier
+            kernel_key (string, optional): key of the kernel the worker holds. Defaults to None.
+
+        Returns:
+            dict: claimed job, None if there are no pending jobs
+        """
+        self.connection.execute("BEGIN IMMEDIATE") # lock the queue, so that every job is claimed by one worker only
+        try:
+            now = time.time()
+            self.connection.execute("UPDATE jobs SET state = 'pending', worker = NULL WHERE state = 'running' AND claimed < ?", (now - self.stale_after,))
+            row = self.connection.execute(f"SELECT {','.join(self.COLUMNS)} FROM jobs WHERE state = 'pending' ORDER BY (kernel_key = ?) DESC, cost DESC LIMIT 1",
+                                          (kernel_key,)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE jobs SET state = 'running', worker = ?, claimed = ? WHERE hash = ?", (worker, now, row[0]))
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        job = dict(zip(self.COLUMNS, row))
+        job['params'] = json.loads(job['params'])
+        return job
+
+    def complete(self, key):
+        """Function to mark a claimed job as done
+
+        Args:
+            key (string): job hash
+        """
+        self.connection.execute("UPDATE jobs SET state = 'done' WHERE hash = ?", (key,))
+
+    def fail(self, key, error):
+        """Function to mark a claimed job as failed, it is not given to other workers
+
+        Args:
+            key (string): job hash
+            error (string): description of the error
+        """
+        self.connection.execute("UPDATE jobs SET state = 'failed', error = ? WHERE hash = ?", (error, key))
+
+    def counts(self):
+        """Function to get the progress of the queue
+
+        Returns:
+            dict: number of jobs for every state ('pending', 'running', 'done', 'failed')
+        """
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        """Function to close the underlying database connection
+        """
+        self.connection.close()
+
+def _predict_all(model, x):
+    """Function to predict all the patterns of 'x' at once, one cross-kernel block between support vectors and patterns
+
+    Args:
+        model (SVR): fitted model
+        x (np.array): input data
+
+    Returns:
+        np.array: predictions, one per pattern
+    """
+    if model.kernel == 'linear':
+        return np.ravel(np.dot(x, model.W.T) + model.intercept)
+    return np.ravel(np.dot(model.betasv.T, k.get_cross_kernel(model, model.sv, x)) + model.intercept)
+
+def run_worker(queue_path, store_path, worker=None, save_models=False, poll=0, max_jobs=None):
+    """Function to run a worker: claims jobs from the queue until it is empty, fits them and saves their results in the store.
+    Data is read from the file each job points to and kept while the following jobs use the same file,
+    the kernel is kept while the following jobs share the same kernel parameters
+
+    Args:
+        queue_path (string): SQLite file of the job queue
+        store_path (string): SQLite file of the results store (see ResultsStore)
+        worker (string, optional): worker identifier. Defaults to None (host name and process id).
+        save_models (bool, optional): if True then fitted models are saved in the store in compact form. Defaults to False.
+        poll (float, optional): if positive the worker waits for new jobs, checking every 'poll' seconds, instead of stopping on an empty queue. Defaults to 0.
+        max_jobs (int, optional): maximum number of jobs to run. Defaults to None (no limit).
+
+    Returns:
+        int: number of jobs run
+    """
+    queue = JobQueue(queue_path)
+    store = ResultsStore(store_path, timeout=60)
+    worker = f"{socket.gethostname()}:{os.getpid()}" if worker is None else worker
+    data_path, data = None, None
+    kernel_key, precomp_kernel = None, None
+    n_jobs = 0
+    while max_jobs is None or n_jobs < max_jobs:
+        job = queue.claim(worker, kernel_key)
+        if job is None:
+            if poll <= 0:
+                break
+            time.sleep(poll)
+            continue
+
+        params = dict(job['params'])
+        try:
+            if params['data_path'] != data_path:
+                data_path = params['data_path']
+                with np.load(data_path) as f:
+                    data = {key: f[key] for key in f.files}
+                kernel_key = None
+            if job['kernel_key'] != kernel_key:
+                # only the last kernel is kept, jobs sharing it are claimed first
+                temp_model = SVR(params['kernel'], params['kparam'])
+                temp_model.xs = data['train_x']
+                precomp_kernel = k.get_kernel(temp_model)
+                kernel_key = job['kernel_key']
+
+            model = SVR(params['kernel'], params['kparam'], params['box'], params['eps'])
+            start_model = time.time()
+            model.fit(data['train_x'], data['train_output'], dict(params['optim_args']), precomp_kernel=precomp_kernel, optim_verbose=False, fit_time=False)
+            fit_time = time.time() - start_model
+            start_eval = time.time()
+            tr_mee = np.mean(np.abs(data['train_output'] - _predict_all(model, data['train_x'])))
+            vl_mee = np.mean(np.abs(data['val_output'] - _predict_all(model, data['val_x'])))
+            del params['data_path'] # results are stored with the same parameters 'Gridsearch.run' stores
+            params['optim_args'] = model.optim_args
+            store.add(job['hash'], job['search'], params, status=model.status, f_best=model.history['fstar'], tr_mee=tr_mee, vl_mee=vl_mee,
+                      fit_time=fit_time, eval_time=time.time() - start_eval, model=model if save_models else None)
+            queue.complete(job['hash'])
+            print(f"(GS - SVR) - worker {worker} - job {job['hash'][:8]} - TR MEE {tr_mee} - VL MEE {vl_mee} - Time taken: {fit_time}")
+        except Exception as e:
+            queue.fail(job['hash'], repr(e))
+            print(f"(GS - SVR) - worker {worker} - job {job['hash'][:8]} failed: {e!r}")
+        n_jobs += 1
+    queue.close()
+    store.close()
+    return n_jobs
+
+if __name__ == '__main__':
+    # e.g. 'python job_queue.py gs_queue.sqlite gs_results.sqlite', once per worker process on every host
+    parser = argparse.ArgumentParser(description="Run a worker of a distributed SVR grid search")
+    parser.add_argument('queue', help="SQLite file of the job queue")
+    parser.add_argument('store', help="SQLite file of the results store")
+    parser.add_argument('--save-models', action='store_true', help="save fitted models in the results store")
+    parser.add_argument('--poll', type=float, default=0, help="seconds between checks for new jobs, 0 to stop on an empty queue")
+    args = parser.parse_args()
+    run_worker(args.queue, args.store, save_models=args.save_models, poll=args.poll)
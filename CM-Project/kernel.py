@@ -1,25 +1,83 @@
 import numpy as np
+try:
+    import scipy.sparse as sparse
+except ImportError: # sparse inputs are supported only when scipy is available
+    sparse = None
+
+def issparse(x):
+    """Check if input is a scipy sparse matrix
+
+    Args:
+        x (object): input
+
+    Returns:
+        bool: True if x is sparse
+    """
+    return sparse is not None and sparse.issparse(x)
+
+def vstack(blocks):
+    """Stack rows of dense or sparse (CSR) inputs
+
+    Args:
+        blocks (list): inputs to stack, either all dense or all sparse
+
+    Returns:
+        np.array: stacked input (CSR matrix if inputs are sparse)
+    """
+    return sparse.vstack(blocks, format='csr') if issparse(blocks[0]) else np.vstack(blocks)
 
 def compute_gamma(x, gamma):
     """Compute correct value of gamma for the kernel
 
     Args:
-        x (np.array): input
+        x (np.array): input (dense or sparse)
         gamma (str): type of gamma desidered (scale, auto)
 
     Returns:
         float: value of gamma 
     """
+    if gamma == 'scale' and issparse(x):
+        # variance over all entries (zeros included) without densifying: E[x^2] - E[x]^2
+        size = x.shape[0]*x.shape[1]
+        variance = x.multiply(x).sum()/size - (x.sum()/size)**2
+        return 1/(x.shape[1]*variance)
     # function to handle special string input values for gamma parameter
     return 1/(x.shape[1]*x.var()) if gamma == 'scale' else 1/x.shape[1] # if(scale) else(auto)
 
-def rbf(v1, v2, gamma='scale'):
-    """Compute RBF kernel
+def _dot(v1, v2):
+    """Compute all the dot products between rows of v1 and rows of v2 (sparse-dense products if any input is sparse)
 
     Args:
         v1 (np.array): list of first input
         v2 (np.array): list of second input
+
+    Returns:
+        np.array: dense matrix of dot products
+    """
+    product = v1 @ v2.T
+    return product.toarray() if issparse(product) else np.asarray(product)
+
+def _squared_norms(v):
+    """Compute squared euclidean norm of every row
+
+    Args:
+        v (np.array): input (dense or sparse)
+
+    Returns:
+        np.array: squared norms
+    """
+    if issparse(v):
+        return np.asarray(v.multiply(v).sum(axis=1)).ravel()
+    return np.einsum('ij,ij->i', v, v)
+
+def rbf(v1, v2, gamma='scale', dtype=np.float64):
+    """Compute RBF kernel
+
+    Args:
+        v1 (np.array): list of first input (dense or sparse)
+        v2 (np.array): list of second input (dense or sparse)
         gamma (str, optional): value of gamma. Defaults to 'scale'.
+        dtype (np.dtype, optional): floating point type of the kernel. Defaults to np.float64.
 
     Returns:
         np.array: kernel
@@ -27,37 +85,35 @@ def rbf(v1, v2, gamma='scale'):
     """
     if isinstance(gamma, str):
         gamma = compute_gamma(v1, gamma)
-    K = np.zeros((v1.shape[0], v2.shape[0]))
-    for i in range(len(K)):
-        for j in range(len(K[0])):
-            K[i,j] = np.exp(-gamma * np.linalg.norm(v1[i]-v2[j])**2)
+    # ||a-b||^2 = ||a||^2 + ||b||^2 - 2a.b, with the row norms computed once
+    sq_dist = _squared_norms(v1)[:, None] + _squared_norms(v2)[None, :] - 2*_dot(v1, v2)
+    K = np.exp(-gamma * np.maximum(sq_dist, 0)).astype(dtype, copy=False) # clip rounding errors
     return K, gamma
 
-def linear(v1, v2):
+def linear(v1, v2, dtype=np.float64):
     """Compute Linear kernel
 
     Args:
-        v1 (np.array): list of first input
-        v2 (np.array): list of second input
+        v1 (np.array): list of first input (dense or sparse)
+        v2 (np.array): list of second input (dense or sparse)
+        dtype (np.dtype, optional): floating point type of the kernel. Defaults to np.float64.
 
     Returns:
         np.array: kernel
     """
-    K = np.zeros((v1.shape[0], v2.shape[0]))
-    for i in range(len(K)):
-        for j in range(len(K[0])):
-            K[i,j] = v1[i].dot(v2[j])
+    K = _dot(v1, v2).astype(dtype, copy=False)
     return K, None
 
-def poly(v1, v2, gamma='scale', deg=3, coef=0.0):
+def poly(v1, v2, gamma='scale', deg=3, coef=0.0, dtype=np.float64):
     """Compute Polynomial kernel
 
     Args:
-        v1 (np.array): list of first input
-        v2 (np.array): list of second input
+        v1 (np.array): list of first input (dense or sparse)
+        v2 (np.array): list of second input (dense or sparse)
         gamma (str, optional): value of gamma. Defaults to 'scale'.
         deg (int, optional): degree. Defaults to 3.
         coef (float, optional): coefficient. Defaults to 0.0.
+        dtype (np.dtype, optional): floating point type of the kernel. Defaults to np.float64.
 
     Returns:
         np.array: kernel
@@ -65,20 +121,18 @@ def poly(v1, v2, gamma='scale', deg=3, coef=0.0):
     """
     if isinstance(gamma, str):
         gamma = compute_gamma(v1, gamma)
-    K = np.zeros((v1.shape[0], v2.shape[0]))
-    for i in range(len(K)):
-        for j in range(len(K[0])):
-            K[i,j] = (gamma * v1[i].dot(v2[j]) + coef) ** deg
+    K = ((gamma * _dot(v1, v2) + coef) ** deg).astype(dtype, copy=False)
     return K, gamma
 
-def sigmoid(v1, v2, gamma='scale', coef=0.0):
+def sigmoid(v1, v2, gamma='scale', coef=0.0, dtype=np.float64):
     """Compute Sigmoid kernel
 
     Args:
-        v1 (np.array): list of first input
-        v2 (np.array): list of second input
+        v1 (np.array): list of first input (dense or sparse)
+        v2 (np.array): list of second input (dense or sparse)
         gamma (str, optional): value of gamma. Defaults to 'scale'.
         coef (float, optional): coefficient. Defaults to 0.0.
+        dtype (np.dtype, optional): floating point type of the kernel. Defaults to np.float64.
 
     Returns:
         np.array: kernel
@@ -86,10 +140,7 @@ def sigmoid(v1, v2, gamma='scale', coef=0.0):
     """
     if isinstance(gamma, str):
         gamma = compute_gamma(v1, gamma)
-    K = np.zeros((v1.shape[0], v2.shape[0]))
-    for i in range(len(K)):
-        for j in range(len(K[0])):
-            K[i,j] = np.tanh(gamma*v1[i].dot(v2[j]) + coef)
+    K = np.tanh(gamma*_dot(v1, v2) + coef).astype(dtype, copy=False)
     return K, gamma
 
 def get_kernel(model):
@@ -102,10 +153,30 @@ def get_kernel(model):
         np.array: kernel
     """
     if model.kernel == 'linear':
-        return linear(model.xs, model.xs)
+        return linear(model.xs, model.xs, model.dtype)
+    elif model.kernel == 'rbf':
+        return rbf(model.xs, model.xs, model.gamma, model.dtype)
+    elif model.kernel == 'poly':
+        return poly(model.xs, model.xs, model.gamma, model.degree, model.coef, model.dtype)
+    elif model.kernel == 'sigmoid':
+        return sigmoid(model.xs, model.xs, model.gamma, model.coef, model.dtype)
+
+def get_cross_kernel(model, v1, v2):
+    """Compute the kernel between two sets of inputs given a fitted SVR model (gamma value already computed)
+
+    Args:
+        model (SVR): fitted svr instance
+        v1 (np.array): list of first input
+        v2 (np.array): list of second input
+
+    Returns:
+        np.array: kernel
+    """
+    if model.kernel == 'linear':
+        return linear(v1, v2, model.dtype)[0]
     elif model.kernel == 'rbf':
-        return rbf(model.xs, model.xs, model.gamma)
+        return rbf(v1, v2, model.gamma_value, model.dtype)[0]
     elif model.kernel == 'poly':
-        return poly(model.xs, model.xs, model.gamma, model.degree, model.coef)
+        return poly(v1, v2, model.gamma_value, model.degree, model.coef, model.dtype)[0]
     elif model.kernel == 'sigmoid':
-        return sigmoid(model.xs, model.xs, model.gamma, model.coef)
\ No newline at end of file
+        return sigmoid(v1, v2, model.gamma_value, model.coef, model.dtype)[0]
@@ -69,8 +69,8 @@ def lin_interp(mu_L, mu_U, betas, box, M):
     Returns:
         float: optimal mu
     """
-    h_L = np.sum(generate_betas(mu_L, betas, box, M))
-    h_U = np.sum(generate_betas(mu_U, betas, box, M))
+    h_L = np.sum(generate_betas(mu_L, betas, box, M), dtype=np.float64)
+    h_U = np.sum(generate_betas(mu_U, betas, box, M), dtype=np.float64)
     return mu_L - h_L*((mu_U-mu_L)/(h_U-h_L))
 
 def adjust_M(M, mu, mode):
@@ -99,7 +99,7 @@ def solveKP(box, linear_constraint, betas, verbose = False):
     while M.size != 0:
         mu = median_of_medians(M)
         temp_betas = generate_betas(mu, betas, box, original_M)
-        betas_sum = np.sum(temp_betas)
+        betas_sum = np.sum(temp_betas, dtype=np.float64) # sum always accumulated in float64
         
         if verbose:
             print(f"\nMEDIAN OF {M} IS {mu}")
@@ -107,7 +107,7 @@ def solveKP(box, linear_constraint, betas, verbose = False):
             print(f"SUM OF BETAS: {betas_sum}")
         
         if betas_sum == linear_constraint: # LUCKY ESCAPE!
-            return np.vstack(temp_betas)
+            return np.vstack(temp_betas).astype(betas.dtype, copy=False)
         elif betas_sum > linear_constraint:
             mu_L = mu
             M = adjust_M(M, mu, 0)
@@ -123,4 +123,4 @@ def solveKP(box, linear_constraint, betas, verbose = False):
         print("SOLUTION FOUND BY LINEAR INTERPOLATION")
     mu = lin_interp(mu_L, mu_U, betas, box, original_M)
     
-    return np.vstack(generate_betas(mu, betas, box, original_M))
\ No newline at end of file
+    return np.vstack(generate_betas(mu, betas, box, original_M)).astype(betas.dtype, copy=False) # keep precision of input betas
\ No newline at end of file
@@ -1,5 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from deflected_subgradient import convergenceRate, historyIterations
 
 def plot_single_model(cup_model, fstar, axs, color, label):
     """ Function to generate the convergence rate, log residual rate and residual rate of a given model 
@@ -13,26 +14,24 @@ def plot_single_model(cup_model, fstar, axs, color, label):
         label (string): to define name of plotted curves
 
     Returns:
-        plot_conv_rate: list of conv rate computed over all function values during fitting
-        log_residual_error: list of log residual error computed over all function values during fitting
-        residual_error: list of residual error computed over all function values during fitting
+        plot_conv_rate: array of per-iteration conv rate computed over all function values during fitting (values recorded with a stride are rescaled)
+        log_residual_error: array of log residual error computed over all function values during fitting
+        residual_error: array of residual error computed over all function values during fitting
     """    
     # set up variables for plotting
     conv_rate_threshold_noise = 100
-    plot_conv_rate = []
-    residual_error = []
-    log_residual_error = []
-    for i in range(len(cup_model.history['f']) - 1):
-        if i < len(cup_model.history['f']) - conv_rate_threshold_noise:
-            plot_conv_rate.append((cup_model.history['f'][i+1] - fstar) / (cup_model.history['f'][i] - fstar))
-        log_residual_error.append(np.log(np.abs(cup_model.history['f'][i] - fstar) / np.abs(fstar)))
-        residual_error.append(np.abs(fstar - cup_model.history['f'][i]) / np.abs(fstar))
-    # plot results
-    axs[0].plot(range(len(plot_conv_rate)), plot_conv_rate, label=label, color=color)
+    f = np.asarray(cup_model.history['f'])
+    iterations = historyIterations(cup_model.history) # values may be recorded every 'stride' iterations
+    noiseless = iterations[:-1] < iterations[-1] - conv_rate_threshold_noise + 1 if len(f) > 0 else np.zeros(0, dtype=bool) # last iterations are noise
+    plot_conv_rate = convergenceRate(f, iterations, fstar)[noiseless]
+    residual_error = np.abs(fstar - f[:-1]) / np.abs(fstar)
+    log_residual_error = np.log(residual_error)
+    # plot results against iteration numbers
+    axs[0].plot(iterations[:-1][noiseless], plot_conv_rate, label=label, color=color)
     axs[0].set_ylabel("CONV_RATE")
-    axs[1].plot(range(len(log_residual_error)), log_residual_error, label=label, color=color)
+    axs[1].plot(iterations[:-1], log_residual_error, label=label, color=color)
     axs[1].set_ylabel("LOG_RESIDUAL_ERROR")
-    axs[2].plot(range(len(residual_error)), residual_error, label=label, color=color)
+    axs[2].plot(iterations[:-1], residual_error, label=label, color=color)
     axs[2].set_ylabel("RESIDUAL_ERROR")
     axs[0].set_ylim(0.5, 1.5)  # to avoid artifacts in plot
     axs[0].legend()
@@ -0,0 +1,153 @@
+import io
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+from SVR import SVR
+
+def _json_default(o):
+    """Function to serialize numpy values found in configurations (e.g. perturbated gamma values)
+    """
+    return o.item() if isinstance(o, np.generic) else str(o)
+
+def config_hash(config):
+    """Function to compute the key of a configuration, independent from dictionaries ordering
+
+    Args:
+        config (dict): configuration, made of json serializable values (numpy scalars allowed)
+
+    Returns:
+        string: hexadecimal sha1 of the configuration
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=_json_default).encode()).hexdigest()
+
+def data_hash(*arrays):
+    """Function to fingerprint the data a configuration is fitted on, so that results on different data never collide
+
+    Args:
+        arrays (np.array): data arrays
+
+    Returns:
+        string: hexadecimal sha1 of the arrays content and shapes
+    """
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+class ResultsStore:
+    """
+    Class' objective is to persist the results of every fitted configuration of a search in a local SQLite file,
+    so that interrupted searches can be resumed and results inspected without refitting:
+        'add' to store a finished configuration
+        'get' to retrieve it (None if not yet completed)
+        'top_k' to query the best configurations
+    """
+    COLUMNS = ['hash', 'search', 'params', 'status', 'f_best', 'tr_mee', 'vl_mee', 'fit_time', 'eval_time', 'created']
+
+    def __init__(self, path, timeout=5):
+        """Open (or create) the store
+
+        Args:
+            path (string): SQLite database file
+            timeout (float, optional): seconds to wait for the database lock held by other processes (see job_queue). Defaults to 5.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                                       hash TEXT PRIMARY KEY, search TEXT, params TEXT, status TEXT,
+                                       f_best REAL, tr_mee REAL, vl_mee REAL, fit_time REAL, eval_time REAL,
+                                       created REAL, model BLOB)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_vl_mee ON results (search, vl_mee)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_f_best ON results (search, f_best)")
+        self.connection.commit()
+
+    def add(self, key, search, params, status=None, f_best=None, tr_mee=None, vl_mee=None, fit_time=None, eval_time=None, model=None):
+        """Function to store a finished configuration, committed immediately so that it survives interruptions
+
+        Args:
+            key (string): configuration hash (see 'config_hash')
+            search (string): name of the search the configuration belongs to
+            params (dict): configuration parameters
+            status (string, optional): exit status of the optimization. Defaults to None.
+            f_best (float, optional): best objective value found. Defaults to None.
+            tr_mee (float, optional): training MEE. Defaults to None.
+            vl_mee (float, optional): validation MEE. Defaults to None.
+            fit_time (float, optional): seconds spent fitting. Defaults to None.
+            eval_time (float, optional): seconds spent evaluating. Defaults to None.
+            model (SVR or MultiSVR, optional): fitted model, stored in compact form (see SVR.save). Defaults to None.
+        """
+        blob = None
+        if model is not None:
+            buffer = io.BytesIO()
+            model.save(buffer)
+            blob = buffer.getvalue()
+        values = [key, search, json.dumps(params, sort_keys=True, default=_json_default), status,
+                  *[None if v is None else float(np.ravel(v)[0]) for v in (f_best, tr_mee, vl_mee, fit_time, eval_time)],
+                  time.time(), blob]
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?,?,?,?,?)", values)
+        self.connection.commit()
+
+    def _to_dict(self, row):
+        """Function to turn a stored row into a dictionary, with parameters decoded
+        """
+        result = dict(zip(self.COLUMNS, row))
+        result['params'] = json.loads(result['params'])
+        return result
+
+    def get(self, key):
+        """Function to retrieve a stored configuration
+
+        Args:
+            key (string): configuration hash
+
+        Returns:
+            dict: stored result (without model), None if the configuration was never completed
+        """
+        row = self.connection.execute(f"SELECT {','.join(self.COLUMNS)} FROM results WHERE hash = ?", (key,)).fetchone()
+        return None if row is None else self._to_dict(row)
+
+    def load_model(self, key, model_class=SVR):
+        """Function to load the model stored together with a configuration
+
+        Args:
+            key (string): configuration hash
+            model_class (class, optional): class whose 'load' reads the stored model. Defaults to SVR.
+
+        Returns:
+            SVR: stored model, None if the configuration has no stored model
+        """
+        row = self.connection.execute("SELECT model FROM results WHERE hash = ?", (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return model_class.load(io.BytesIO(row[0]))
+
+    def top_k(self, k, order_by='vl_mee', search=None):
+        """Function to query the best configurations
+
+        Args:
+            k (int): number of configurations to return
+            order_by (string, optional): 'vl_mee', 'tr_mee', 'f_best', 'fit_time' or 'eval_time', lowest first. Defaults to 'vl_mee'.
+            search (string, optional): if given only configurations of this search are considered. Defaults to None.
+
+        Returns:
+            list: stored results (without models), best first
+        """
+        if order_by not in ['vl_mee', 'tr_mee', 'f_best', 'fit_time', 'eval_time']:
+            raise ValueError(f"Cannot order results by '{order_by}'")
+        query = f"SELECT {','.join(self.COLUMNS)} FROM results WHERE {order_by} IS NOT NULL"
+        args = []
+        if search is not None:
+            query += " AND search = ?"
+            args.append(search)
+        query += f" ORDER BY {order_by} ASC LIMIT ?"
+        args.append(k)
+        return [self._to_dict(row) for row in self.connection.execute(query, args)]
+
+    def close(self):
+        """Function to close the underlying database connection
+        """
+        self.connection.close()
@@ -3,6 +3,8 @@ import math
 import time
 import kernel as k
 from SVR import SVR
+from kp import solveKP
+from results_store import config_hash, data_hash
 
 class Gridsearch():
     """Class constructed to behave as grid search on model parameters.
@@ -31,8 +33,10 @@ class Gridsearch():
         if "optiargs" in param:
             self.opti_args = param["optiargs"]
 
-    def run(self, train_x, train_output, val_x, val_output, convergence_verbose=False):
-        """Run grid search, returning best performing model based on MEE
+    def run(self, train_x, train_output, val_x, val_output, convergence_verbose=False, store=None, save_models=False):
+        """Run grid search, returning best performing model based on MEE.
+        If a results store is given every finished configuration is saved in it as soon as it is evaluated,
+        and configurations already completed on the same data are skipped
 
         Args:
             train_x (np.array): input training data
@@ -40,6 +44,8 @@ class Gridsearch():
             val_x (np.array): input validation data (model selection)
             val_output (np.array): output validation data (model selection)
             convergence_verbose (bool, optional): if set to True then at every model fitting end there will be plots on convergence rate and logarithmic residual error. Defaults to False.
+            store (ResultsStore, optional): persistent store of the results, makes the search resumable. Defaults to None.
+            save_models (bool, optional): if True then fitted models are saved in the store in compact form. Defaults to False.
 
         Returns:
             SVR: best performing model
@@ -62,49 +68,50 @@ class Gridsearch():
             precomp_kernel, precomp_gamma_value = k.get_kernel(temp_model)
             precomp_kernels[i] = (precomp_kernel, precomp_gamma_value)
         
-        print(f"(GS - SVR) - Fitting {len(models_conf)} models")
+        # configurations already completed in the store (previous runs on the same data) are not fitted again
+        keys = [None]*len(models_conf)
+        if store is not None:
+            data_key = data_hash(train_x, train_output, val_x, val_output)
+            keys = [config_hash({**config, 'data': data_key}) for config in self.configurations()]
+
+        print(f"(GS - SVR) - Fitting and evaluating {len(models_conf)} models")
         start_fit = time.time()
+        models_meet = []
+        models_mee = []
+        fitted = [False]*len(models_conf)
         for i, model in enumerate(models_conf):
             print(f"(GS - SVR) - model {i+1}/{len(models_conf)}", sep=" ")
-            model.fit(train_x, train_output, self.opti_args[i%len(self.opti_args)], optim_verbose=False, precomp_kernel=precomp_kernels[kernel_conf[i]], convergence_verbose=convergence_verbose)
+            stored = store.get(keys[i]) if store is not None else None
+            if stored is not None:
+                print("\t(GS - SVR) - Already completed, skipped")
+                models_meet.append(stored['tr_mee'])
+                models_mee.append(stored['vl_mee'])
+                continue
+            start_model = time.time()
+            model.fit(train_x, train_output, dict(self.opti_args[i%len(self.opti_args)]), optim_verbose=False, precomp_kernel=precomp_kernels[kernel_conf[i]], convergence_verbose=convergence_verbose)
+            fitted[i] = True
+            fit_time = time.time() - start_model
             print(f"\t(GS - SVR) - Time taken: {time.time() - start_fit} - Remaining: {(time.time() - start_fit) / (i+1) * (len(models_conf)-i-1)}")
-        
-        print("(GS - SVR) - Evaluating models")
-
-        # get models predictions on training data
-        models_predt = []
-        for i, model in enumerate(models_conf):
-            tmp_pred = []
-            for inp in train_x:
-                prediction = model.predict(inp)
-                tmp_pred.append(prediction)
-            models_predt.append(tmp_pred)
 
-        # compute training MEE for all models
-        models_meet = []
-        for i, pred in enumerate(models_predt):
+            # compute training MEE
+            start_eval = time.time()
             error = 0
-            for j, train_pred in enumerate(pred):
-                error += math.sqrt((train_output[j] - train_pred)**2)
+            for j, inp in enumerate(train_x):
+                error += math.sqrt((train_output[j] - model.predict(inp).item())**2)
             models_meet.append(error/len(train_output))
 
-        # get models predictions on validation data
-        models_pred = []
-        for i, model in enumerate(models_conf):
-            tmp_pred = []
-            for inp in val_x:
-                prediction = model.predict(inp)
-                tmp_pred.append(prediction)
-            models_pred.append(tmp_pred)
-
-        # compute validation MEE for all models
-        models_mee = []
-        for i, pred in enumerate(models_pred):
+            # compute validation MEE
             error = 0
-            for j, val_pred in enumerate(pred):
-                error += math.sqrt((val_output[j] - val_pred)**2)
+            for j, inp in enumerate(val_x):
+                error += math.sqrt((val_output[j] - model.predict(inp).item())**2)
             models_mee.append(error/len(val_output))
 
+            if store is not None:
+                store.add(keys[i], 'model', {'kernel': model.kernel, 'kparam': self.k_params[kernel_conf[i]], 'box': model.box, 'eps': model.eps,
+                                             'optim_args': model.optim_args}, status=model.status, f_best=model.history['fstar'],
+                          tr_mee=models_meet[i], vl_mee=models_mee[i], fit_time=fit_time, eval_time=time.time() - start_eval,
+                          model=model if save_models else None)
+
         # print out results
         for i in range(len(models_mee)):
             print(f"(GS - SVR) - SVR: {i} - TR MEE {models_meet[i]} - VL MEE {models_mee[i]} - MODEL: {models_conf[i]}\n")
@@ -112,8 +119,118 @@ class Gridsearch():
         # get best performing model on validation set, return it
         index = np.argmin(models_mee)
         print("(GS - SVR) - Best configuration:", index)
+        if not fitted[index]:
+            # best configuration comes from a previous run: load it if stored, otherwise fit it again
+            best_model = store.load_model(keys[index]) if save_models else None
+            if best_model is not None:
+                return best_model
+            models_conf[index].fit(train_x, train_output, dict(self.opti_args[index%len(self.opti_args)]), optim_verbose=False, precomp_kernel=precomp_kernels[kernel_conf[index]], convergence_verbose=convergence_verbose)
         return models_conf[index]
 
+    def configurations(self):
+        """Function to list the configurations of the grid, in the same order 'run' fits them
+
+        Returns:
+            list: one dictionary per configuration, with 'kernel', 'kparam', 'box', 'eps' and 'optim_args'
+        """
+        return [{'kernel': kernel, 'kparam': self.k_params[i], 'box': box, 'eps': eps, 'optim_args': optim_args}
+                for i, kernel in enumerate(self.kernel) for box in self.box for eps in self.eps for optim_args in self.opti_args]
+
+    def submit(self, queue, train_x, train_output, val_x, val_output, data_path, store=None):
+        """Function to distribute the grid search: data is saved to 'data_path' (on a filesystem shared with the workers)
+        and every configuration becomes a job of the queue, with cost estimated as kernel size times maximum number of iterations.
+        Workers are then started with 'job_queue.run_worker' on any host; once the queue is done, 'run' with the same store
+        skips all the configurations and returns the best model
+
+        Args:
+            queue (JobQueue): queue the jobs are submitted to
+            train_x (np.array): input training data
+            train_output (np.array): output training data
+            val_x (np.array): input validation data (model selection)
+            val_output (np.array): output validation data (model selection)
+            data_path (string): '.npz' file the data is saved to, read by the workers
+            store (ResultsStore, optional): if given then configurations already completed in it are not submitted. Defaults to None.
+
+        Returns:
+            int: number of submitted jobs
+        """
+        np.savez(data_path, train_x=train_x, train_output=train_output, val_x=val_x, val_output=val_output)
+        data_key = data_hash(train_x, train_output, val_x, val_output)
+        jobs = []
+        for config in self.configurations():
+            key = config_hash({**config, 'data': data_key})
+            if store is not None and store.get(key) is not None:
+                continue
+            kernel_key = config_hash({'kernel': config['kernel'], 'kparam': config['kparam'], 'data': data_key})
+            cost = train_x.shape[0]**2 * config['optim_args'].get('maxiter', 1e5) # kernel products dominate every iteration
+            jobs.append((key, {**config, 'data_path': data_path}, kernel_key, cost))
+        submitted = queue.submit('model', jobs)
+        print(f"(GS - SVR) - Submitted {submitted} jobs to {queue.path}")
+        return submitted
+
+    def run_kfold(self, x, y, n_folds=5, seed=None, convergence_verbose=False):
+        """Run grid search with k-fold cross validation, returning best performing model based on average validation MEE,
+        refitted on the whole data. Every kernel is computed once over the whole data: each fold is fitted on the
+        submatrix of its training patterns and evaluated through the off-diagonal block (support vectors x validation patterns).
+        Fold fits of the same configuration are warm started from the betas found by the previous folds.
+        Note that gamma 'scale'/'auto' is computed over the whole data, not over each fold
+
+        Args:
+            x (np.array): input data (development set)
+            y (np.array): output data (development set)
+            n_folds (int, optional): number of folds. Defaults to 5.
+            seed (int, optional): if given then patterns are shuffled before splitting into folds. Defaults to None.
+            convergence_verbose (bool, optional): if set to True then at every model fitting end there will be plots on convergence rate and logarithmic residual error. Defaults to False.
+
+        Returns:
+            SVR: best performing model, fitted on the whole data
+        """
+        indexes = np.arange(x.shape[0]) if seed is None else np.random.RandomState(seed).permutation(x.shape[0])
+        folds = np.array_split(indexes, n_folds)
+        y = np.ravel(y)
+
+        models_conf = [] # (kernel index, box, eps, optim_args)
+        models_tr_mee = []
+        models_vl_mee = []
+        models_beta = [] # betas over the whole data, used for warm starts
+        precomp_kernels = {}
+        start_fit = time.time()
+        for i, kernel in enumerate(self.kernel):
+            # compute kernel over the whole data, shared by all folds and configurations
+            temp_model = SVR(kernel, self.k_params[i])
+            temp_model.x, temp_model.xs = x, x
+            precomp_kernels[i] = k.get_kernel(temp_model)
+            K, gamma_value = precomp_kernels[i]
+            for box in self.box:
+                for eps in self.eps:
+                    for optim_args in self.opti_args:
+                        print(f"(GS - SVR) - {n_folds}-fold model {len(models_conf)+1} - Time taken: {time.time() - start_fit}")
+                        beta = np.zeros((x.shape[0], 1))
+                        tr_mee, vl_mee = 0, 0
+                        for fold in folds:
+                            train = np.setdiff1d(indexes, fold)
+                            model = SVR(kernel, self.k_params[i], box, eps)
+                            beta_init = solveKP(box, 0, beta[train], False) # warm start from previous folds
+                            model.fit(x[train], y[train], dict(optim_args), beta_init=beta_init, precomp_kernel=[K[np.ix_(train, train)], gamma_value], optim_verbose=False, convergence_verbose=convergence_verbose, fit_time=False)
+                            beta[train] = model.beta
+                            # predict through the kernel blocks between support vectors and training/validation patterns
+                            sv = train[model.sv_indexes]
+                            tr_mee += np.mean(np.abs(np.dot(model.betasv.T, K[np.ix_(sv, train)]).ravel() + model.intercept - y[train])) / n_folds
+                            vl_mee += np.mean(np.abs(np.dot(model.betasv.T, K[np.ix_(sv, fold)]).ravel() + model.intercept - y[fold])) / n_folds
+                        models_conf.append((i, box, eps, optim_args))
+                        models_tr_mee.append(tr_mee)
+                        models_vl_mee.append(vl_mee)
+                        models_beta.append(beta)
+                        print(f"(GS - SVR) - SVR: {len(models_conf)-1} - TR MEE {tr_mee} - VL MEE {vl_mee} - KERNEL: {kernel} {self.k_params[i]} - BOX: {box} - EPS: {eps} - OPTIM_ARGS: {optim_args}\n")
+
+        # refit best configuration on the whole data, warm started from its folds betas
+        index = np.argmin(models_vl_mee)
+        print("(GS - SVR) - Best configuration:", index)
+        i, box, eps, optim_args = models_conf[index]
+        model = SVR(self.kernel[i], self.k_params[i], box, eps)
+        model.fit(x, y, dict(optim_args), beta_init=solveKP(box, 0, models_beta[index], False), precomp_kernel=precomp_kernels[i], optim_verbose=False, convergence_verbose=convergence_verbose)
+        return model
+
     def get_model_perturbations(self, model, n_perturbations, n_optimargs, n_box_perturb=1):
         """Function to create perturbated configurations. Useful for 'fine grid search'
 
@@ -3,10 +3,10 @@ import numpy as np
 import math
 import time
 import get_cup_dataset as dt
-import pickle
 import copy
 
 from SVR import SVR
+from results_store import ResultsStore, config_hash, data_hash
 
 class Gridsearch():
     """
@@ -47,10 +47,11 @@ class Gridsearch():
         if "optiargs" in param:
             self.opti_args = param["optiargs"]
 
-    def run(self, inp, out, target_func_value=None, max_error_target_func_value=None, n_best=1, convergence_verbose=False):
+    def run(self, inp, out, target_func_value=None, max_error_target_func_value=None, n_best=1, convergence_verbose=False, store=None, save_models=False):
         """
         Function to effectively run the GridSearch, returns top n performing models configuration.
         The performance is evaluated on reaching the lowest possible minimum (algorithmic aim).
+        If a results store is given every finished configuration is saved in it, and configurations already completed on the same data are skipped.
         Args:
             inp (np.array): input data
             out (np.array): output data
@@ -58,9 +59,11 @@ class Gridsearch():
             max_error_target_func_value (float, optional): range of error around target_func_value to define 'accepted' convergence condition. Defaults to None.
             n_best (int): number of best models configurations to return
             convergence_verbose (bool, optional): if set to True then at every model fitting end there will be plots on convergence rate and logarithmic residual error. Defaults to False.
+            store (ResultsStore, optional): persistent store of the results, makes the search resumable. Defaults to None.
+            save_models (bool, optional): if True then fitted models are saved in the store in compact form. Defaults to False.
 
         Returns:
-            list(SVR): best performing models configurations
+            list(SVR): best performing models, fitted and kept in compact form (see SVR.drop_train_state)
         """
         # check and set possible undeclared parameters about objective target
         if target_func_value is None:
@@ -78,19 +81,41 @@ class Gridsearch():
                         models_conf.append(SVR(kernel, self.k_params[i], box, eps))
                         kernel_conf.append(i) # to get correct kernel afterwards
         
+        # configurations already completed in the store (previous runs on the same data) are not fitted again
+        keys = [None]*len(models_conf)
+        if store is not None:
+            data_key = data_hash(inp, out)
+            for i, model in enumerate(models_conf):
+                keys[i] = config_hash({'kernel': model.kernel, 'kparam': self.k_params[kernel_conf[i]], 'box': model.box, 'eps': model.eps,
+                                       'optim_args': self.opti_args[i%len(self.opti_args)], 'target_func_value': target_func_value[model.kernel],
+                                       'max_error_target_func_value': max_error_target_func_value, 'data': data_key})
+
         print(f"(GS - SVR) - Fitting {len(models_conf)} models")
         start_fit = time.time()
         f_bests = np.zeros(len(models_conf))
-        # copy and delete models after fitting to avoid RAM overflow
+        fitted = [False]*len(models_conf)
+        # drop training data, kernel and history of models after fitting to avoid RAM overflow
         for i, model in enumerate(models_conf):
             print(f"(GS - SVR) - model {i+1}/{len(models_conf)}", sep=" ")
+            stored = store.get(keys[i]) if store is not None else None
+            if stored is not None:
+                print(f"(GS - SVR) - SVR: {i} already completed, skipped - EXIT_STATUS: {stored['status']} - F_BEST: {stored['f_best']}")
+                f_bests[i] = stored['f_best']
+                continue
             copied_model = copy.deepcopy(model)
-            copied_model.fit(inp, out, self.opti_args[i%len(self.opti_args)], target_func_value=target_func_value[model.kernel], max_error_target_func_value=max_error_target_func_value, optim_verbose=False, convergence_verbose=convergence_verbose)
+            start_model = time.time()
+            copied_model.fit(inp, out, dict(self.opti_args[i%len(self.opti_args)]), target_func_value=target_func_value[model.kernel], max_error_target_func_value=max_error_target_func_value, optim_verbose=False, convergence_verbose=convergence_verbose, keep_train_state=False)
+            fit_time = time.time() - start_model
             print("_"*100)
             print(f"\n\t(GS - SVR) - Time taken: {time.time() - start_fit} - Remaining: {(time.time() - start_fit) / (i+1) * (len(models_conf)-i-1)}")
             print(f"(GS - SVR) - SVR: {i} \nEXIT_STATUS: {copied_model.status} - F_BEST: {copied_model.history['fstar']} \nMODEL_OPTIM_ARGS: {copied_model.optim_args} \nMODEL_KERNEL(name/gamma/degree/coef0): {copied_model.kernel} {copied_model.gamma_value}/{copied_model.degree}/{copied_model.coef} \nMODEL_BOX: {copied_model.box}\n")
             f_bests[i] = copied_model.history['fstar']
-            del copied_model
+            models_conf[i] = copied_model
+            fitted[i] = True
+            if store is not None:
+                store.add(keys[i], 'algorithmic', {'kernel': model.kernel, 'kparam': self.k_params[kernel_conf[i]], 'box': model.box, 'eps': model.eps,
+                                                   'optim_args': copied_model.optim_args}, status=copied_model.status, f_best=f_bests[i],
+                          fit_time=fit_time, model=copied_model if save_models else None)
         
         # check if the number of requested models is valid
         n_best = n_best if n_best <= len(models_conf) else len(models_conf)
@@ -98,6 +123,14 @@ class Gridsearch():
         # get the n_best models with the lowest f_best, print them, return their configuration
         best_indexes = np.argsort(f_bests)[:n_best]
         print("(GS - SVR) - Best configurations:", best_indexes, " with f_best ", np.sort(f_bests)[:n_best])
+        for i in best_indexes:
+            if not fitted[i]:
+                # best configuration comes from a previous run: load it if stored, otherwise fit it again
+                stored_model = store.load_model(keys[i]) if save_models else None
+                if stored_model is None:
+                    stored_model = copy.deepcopy(models_conf[i])
+                    stored_model.fit(inp, out, dict(self.opti_args[i%len(self.opti_args)]), target_func_value=target_func_value[stored_model.kernel], max_error_target_func_value=max_error_target_func_value, optim_verbose=False, convergence_verbose=convergence_verbose, keep_train_state=False)
+                models_conf[i] = stored_model
         return [models_conf[i] for i in best_indexes]
     
 if __name__ == '__main__':
@@ -149,13 +182,14 @@ if __name__ == '__main__':
         optiargs=optiargs
     )
 
-    # run grid search, saving best configurations
+    # run grid search, saving best configurations; results are stored as they come, so an interrupted search is resumed
+    store = ResultsStore(os.path.dirname(__file__) + "/gs_results.sqlite")
     best_models_configurations = gs.run(
-        data, data_out, target_func_value=target_func_value, n_best=5
+        data, data_out, target_func_value=target_func_value, n_best=5, store=store, save_models=True
     )
 
-    # save best models configuration to output file
-    save_path = os.path.dirname(__file__) + "/gs_models/gs_out"
-    with open(save_path, "wb") as f:
-        pickle.dump({"models": best_models_configurations}, f, protocol=pickle.HIGHEST_PROTOCOL)
-        print(f"GridSearch output configuration succesfully saved to {save_path}")
+    # save best models in compact form (support vectors only) to output files
+    for i, model in enumerate(best_models_configurations):
+        save_path = os.path.dirname(__file__) + f"/gs_models/gs_out_{i}.npz"
+        model.save(save_path)
+        print(f"GridSearch output model succesfully saved to {save_path}")
@@ -0,0 +1,20 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # CM-Project modules are imported flat
+import get_cup_dataset as dt
+from SVR import SVR
+
+def _predict(model, x):
+    return np.array([np.ravel(model.predict(pattern)) for pattern in x])
+
+def test_compress_near_constant_model():
+    # with a tiny box every prediction is within tol from the intercept: no expansion vector is needed
+    x, y = dt._get_cup('train')
+    x, y = x[:200], y[:200, 0]
+    model = SVR('rbf', box=1e-6, eps=0.1)
+    model.fit(x, y, {'maxiter': 200}, optim_verbose=False, fit_time=False)
+    compressed = model.compress(x[:50], tol=1e-3)
+    assert compressed.betasv.shape == (0, 1) and compressed.sv.shape[0] == 0
+    assert np.max(np.abs(_predict(compressed, x[:50]) - _predict(model, x[:50]))) <= 1e-3
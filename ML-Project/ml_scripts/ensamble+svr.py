@@ -1,28 +1,33 @@
 import os
 import sys
+import itertools
 import pickle
 import numpy as np
 from utils.plot import Plot
 import utils.get_dataset as dt
 from utils.model import Model
-sys.path.append(os.path.abspath('../cm_scripts'))
-from SVR import SVR
+# the SVR side of the ensemble comes from CM-Project
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'CM-Project'))
+from MultiSVR import MultiSVR
 import get_cup_dataset as dt1
 
-def get_svr_model():
+def get_svr_model(model_path="models/svr_model.npz"):
+    # fitted model is saved in compact form, so that it is loaded instead of refitted on every run
+    if os.path.exists(model_path):
+        print("Loading both dimensions model..")
+        return MultiSVR.load(model_path)
     train, train_labels = dt1._get_cup('train')
-    train_labels1, train_labels2 = train_labels[:,0], train_labels[:,1]
 
-    cup_model_1 = SVR('rbf',{'gamma':0.1}, box=1, eps=0.1) # values found with grid search results
-    cup_model_2 = SVR('rbf',{'gamma':0.1}, box=1, eps=0.1) # values found with grid search results
-    beta_init = np.vstack(np.zeros(train.shape[0]))
-    print("Fitting first dimension model..")
-    cup_model_1.fit(train, train_labels1, optim_args={'eps': 0.08737368906085892, 'vareps': 0.1, 'maxiter': 3000.0}, beta_init=beta_init, verbose_optim=False)
-    print("Fitting second dimension model..")
-    cup_model_2.fit(train, train_labels2, optim_args={'eps': 0.06803885259228548, 'vareps': 0.1, 'maxiter': 3000.0}, beta_init=beta_init, verbose_optim=False)
-    return [cup_model_1, cup_model_2]
+    # both output dimensions share the same kernel (values found with grid search results), so they are fitted together
+    cup_model = MultiSVR('rbf',{'gamma':0.1}, box=1, eps=0.1, n_outputs=2)
+    print("Fitting both dimensions model..")
+    cup_model.fit(train, train_labels, optim_args=[{'eps': 0.08737368906085892, 'vareps': 0.1, 'maxiter': 3000.0},
+                                                   {'eps': 0.06803885259228548, 'vareps': 0.1, 'maxiter': 3000.0}], optim_verbose=False, keep_train_state=False)
+    cup_model.save(model_path)
+    return cup_model
 
-def ensemblewithSVR_inference(svr_model, plot=False):
+def ensemblewithSVR_inference(svr_model, plot=False, test_source='test', chunk_size=1000, out_path="ff15_ML-CUP20-TS.csv"):
+    # test_source is either 'test', a csv path in ML-CUP format or an (optionally memory-mapped) array of inputs
     print("Inference..")
 
     # loading ensemble
@@ -39,30 +44,30 @@ def ensemblewithSVR_inference(svr_model, plot=False):
     if plot: Plot._plot_train_stats(ensemble_stats[:3], epochs=[len(stats) for stats in ensemble_stats[:3]], classification=False, title=f"Ensemble Models", max_graphs_per_row=3)
     if plot: Plot._plot_train_stats(ensemble_stats[3:], epochs=[len(stats) for stats in ensemble_stats[3:]], classification=False, title=f"Ensemble Models", max_graphs_per_row=2)
 
-    test, _ = dt._get_cup('test')
-    out = []
-    for inp in test:
-        output = np.array([0, 0])
-        # compute blind test ensemble
-        for i in range(num_models):
-            output = output + np.array(ensemble_models[i]._feed_forward(inp))
-        ens_out = output/num_models
-        # compute blind test svr
-        svr_out = np.array([float(svr_model[0].predict(inp)), float(svr_model[1].predict(inp))])
-        out.append(0.5*ens_out+0.5*svr_out)
+    def blind_test_predictions():
+        # blind test is read and predicted chunk by chunk, so memory does not grow with the test set
+        chunks, svr_chunks = itertools.tee(dt1._iter_cup_chunks(test_source, chunk_size)) # the svr reads the same chunks
+        for test, svr_out in zip(chunks, svr_model.predict_chunks(svr_chunks)):
+            # compute blind test ensemble, one forward pass per model on the whole chunk
+            ens_out = sum(model._feed_forward_batch(test) for model in ensemble_models)/num_models
+            yield 0.5*ens_out+0.5*svr_out
 
-    # save results
-    with open("ff15_ML-CUP20-TS.csv", "w") as f:
+    return write_ml_cup_ts(blind_test_predictions(), out_path)
+
+def write_ml_cup_ts(predictions, out_path="ff15_ML-CUP20-TS.csv"):
+    # predictions is an iterable of blocks (one row per pattern, one column per output), written as soon as they come
+    count = 0
+    with open(out_path, "w") as f:
         f.write("# Elia Piccoli, Nicola Gugole\n")
         f.write("# ff15\n")
         f.write("# ML-CUP20 v1\n")
         f.write("# 15-06-2021\n")
-        for i,o in enumerate(out):
-            f.write(f"{i+1},{o[0]},{o[1]}\n")
-
-    return out
+        for block in predictions:
+            for o in block:
+                count += 1
+                f.write(f"{count},{o[0]},{o[1]}\n")
+    return count
 
-    
 if __name__=="__main__":
     svr_model = get_svr_model()
     ensemblewithSVR_inference(svr_model)
\ No newline at end of file
@@ -3,11 +3,27 @@ import utils.get_dataset as dt
 import os
 import pickle
 import math
+import time
+import heapq
+import tempfile
 
 from utils.layer import Layer
-from utils.model import Model
+from utils.model import Model, _early_stopping_state
+from utils.population import Population
 from utils.plot import Plot
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, parallel_config
+
+def _shared_array(values, folder, name):
+    # contiguous copy saved once: joblib hands memmaps to the workers by file name, so tasks do not carry the data
+    path = os.path.join(folder, f"{name}.npy")
+    np.save(path, np.ascontiguousarray(values, dtype=np.float64))
+    return np.load(path, mmap_mode='r')
+
+def _timed(task, *args):
+    # runs a task in a worker, returning its training time together with its results
+    start = time.perf_counter()
+    result = task(*args)
+    return time.perf_counter() - start, result
 
 class GridSearch:
     def __init__(self):
@@ -64,14 +80,115 @@ class GridSearch:
 
         return score
 
-    def _train_model(self, index, model, train, train_label, validation, validation_label, batch_size, epoch, decay):
-        train_result = model._train(train, train_label, validation, validation_label, batch_size=batch_size, epoch=epoch, decay=decay)
-        save_file = f"models/cup_conf{index}"
-        with open(save_file, 'wb') as f:
-            pickle.dump({"model": model, "layers": model.layers}, f, protocol=pickle.HIGHEST_PROTOCOL)
-        return train_result
+    def _train_model(self, index, model, train, train_label, validation, validation_label, batch_size, epoch, decay, patience=0, early_stopping=None):
+        # only stats, flat trained parameters, learning rate and early stopping state go back to the parent, see _restore_model
+        # the best epoch is not restored here: the model may be trained further by successive halving
+        # the shared arrays are read in place, Model._train only shuffles the patterns order
+        early_stopping = _early_stopping_state() if early_stopping is None else early_stopping
+        train_result = model._train(train, train_label, validation, validation_label, batch_size=batch_size, epoch=epoch, decay=decay, patience=patience, early_stopping=early_stopping)
+        return [(index, train_result, model._get_parameters(), model.eta, early_stopping)]
+
+    def _train_population(self, indexes, configurations, train, train_label, validation, validation_label, patience=0, early_stopping=None):
+        # configurations share architecture, epoch and batch size: trained together, returned one by one as in _train_model
+        epoch, batch_size = configurations[0][0], configurations[0][1]
+        models = [configuration[3] for configuration in configurations]
+        states = [_early_stopping_state() if state is None else state for state in (early_stopping or [None]*len(models))]
+        train_results = Population(models)._train(train, train_label, validation, validation_label, batch_size=batch_size, epoch=epoch, decay=[configuration[2] for configuration in configurations], patience=patience, early_stopping=states)
+        return [(index, train_result, model._get_parameters(), model.eta, state) for index, train_result, model, state in zip(indexes, train_results, models, states)]
+
+    def _build_model(self, structure, eta, alpha, _lambda, weight_matrix=None):
+        model = Model()
+        for model_layer in structure:
+            layer = Layer(model_layer.nodes, model_layer.activation_function_type, _input=model_layer.input)
+            model._add_layer(layer)
+        # weight arrays are copied into the model flat parameters buffer
+        model._compile(eta=eta, alpha=alpha, _lambda=_lambda, weight_matrix=weight_matrix, isClassification = False, gradient_clipping=True)
+        return model
+
+    def _restore_model(self, structure_index, configuration_index, configurations_per_model, parameters, eta=None):
+        # rebuilds a trained model of the search from its flat parameters (and decayed learning rate, to continue training it)
+        model_parameters = self._get_model_parameters(configuration_index, configurations_per_model)
+        model = self._build_model(self.models_layers[structure_index], model_parameters['eta'], model_parameters['alpha'], model_parameters['_lambda'])
+        model._set_parameters(parameters)
+        if eta is not None:
+            model.eta = eta
+        model.batch_size = model_parameters['batch_size']
+        model.decay_ratio = model_parameters['lr_decay']
+        return model
+
+    def _generate_models(self, weights_per_configuration, familyofmodelsperconfiguration, indexes):
+        # yields (index, epoch, batch, decay, compiled_model) one at a time, in the order of indexes: models are built only when a worker can take them
+        # grid index = ((structure*len(weight_range) + weight_range_index)*family + family_index)*configurations_per_model + configuration
+        configurations_per_model = len(self.epoch)*len(self.batch_size)*len(self.lr_decay)*len(self.eta)*len(self.alpha)*len(self._lambda)
+        for index in indexes:
+            weights_index, configuration = divmod(index, configurations_per_model)
+            structure = self.models_layers[weights_index//(len(self.weight_range)*familyofmodelsperconfiguration)]
+            model_parameters = self._get_model_parameters(configuration, configurations_per_model)
+            weight_matrix = weights_per_configuration[weights_index//familyofmodelsperconfiguration][weights_index%familyofmodelsperconfiguration]
+            model = self._build_model(structure, model_parameters['eta'], model_parameters['alpha'], model_parameters['_lambda'], weight_matrix=weight_matrix)
+            yield (index, model_parameters['epoch'], model_parameters['batch_size'], model_parameters['lr_decay'], model)
+
+    def _structure_parameters(self, structure):
+        inputs = structure[0].input[0]
+        parameters = 0
+        for layer in structure:
+            parameters += layer.nodes*(inputs + 1)
+            inputs = layer.nodes
+        return parameters
+
+    def _longest_first(self, indexes, models_per_structure, n_samples, trained_epochs=0, budget=math.inf):
+        # expected cost of a model: parameters x epochs x samples/batch (updates of every parameter), most expensive first
+        # so that long jobs do not end up alone at the end of the search; equal costs keep structure, epoch and batch size together (populations)
+        configurations_per_model = len(self.epoch)*len(self.batch_size)*len(self.lr_decay)*len(self.eta)*len(self.alpha)*len(self._lambda)
+        structures_parameters = [self._structure_parameters(structure) for structure in self.models_layers]
+        def cost_key(index):
+            structure_index, j = divmod(index, models_per_structure)
+            model_parameters = self._get_model_parameters(j%configurations_per_model, configurations_per_model)
+            epochs = min(model_parameters['epoch'], budget) - trained_epochs
+            cost = structures_parameters[structure_index]*epochs*math.ceil(n_samples/model_parameters['batch_size'])
+            return (-cost, structure_index, model_parameters['epoch'], model_parameters['batch_size'], index)
+        return sorted(indexes, key=cost_key)
 
-    def _run(self, train, train_label, validation, validation_label, familyofmodelsperconfiguration=1):
+    def _promoted_models(self, promoted, models_per_structure, configurations_per_model):
+        # models promoted by successive halving, rebuilt in the given order as (index, epoch, batch, decay, model)
+        for index, parameters, eta in promoted:
+            i, j = divmod(index, models_per_structure)
+            model_parameters = self._get_model_parameters(j%configurations_per_model, configurations_per_model)
+            model = self._restore_model(i, j%configurations_per_model, configurations_per_model, parameters, eta)
+            yield (index, model_parameters['epoch'], model_parameters['batch_size'], model_parameters['lr_decay'], model)
+
+    def _round_models(self, models, trained_epochs, budget):
+        # each model is trained up to budget epochs in total (never past its own epoch): decay is rescaled
+        # so that the learning rate follows the schedule of a single run of epoch epochs
+        for index, epoch, batch_size, decay, model in models:
+            epochs = min(epoch, budget) - trained_epochs
+            yield (index, epochs, batch_size, decay if epochs == epoch else decay*epoch/epochs, model)
+
+    def _generate_tasks(self, models, models_per_structure, train, train_label, validation, validation_label, population_size=0, patience=0, early_stopping=None):
+        # one joblib task per model, or per population of consecutive models sharing structure, epoch and batch size
+        # early_stopping: index -> early stopping state of the models trained in the previous rounds
+        # tasks return (training time, results)
+        early_stopping = {} if early_stopping is None else early_stopping
+        if population_size <= 0:
+            for index, epoch, batch_size, decay, model in models:
+                yield delayed(_timed)(self._train_model, index, model, train, train_label, validation, validation_label, batch_size, epoch, decay, patience, early_stopping.get(index))
+            return
+        population = []
+        for index, epoch, batch_size, decay, model in models:
+            if len(population) > 0 and (len(population) == population_size or population[0][0]//models_per_structure != index//models_per_structure or population[0][1:3] != (epoch, batch_size)):
+                yield delayed(_timed)(self._train_population, [c[0] for c in population], [c[1:] for c in population], train, train_label, validation, validation_label, patience, [early_stopping.get(c[0]) for c in population])
+                population = []
+            population.append((index, epoch, batch_size, decay, model))
+        if len(population) > 0:
+            yield delayed(_timed)(self._train_population, [c[0] for c in population], [c[1:] for c in population], train, train_label, validation, validation_label, patience, [early_stopping.get(c[0]) for c in population])
+
+    def _run(self, train, train_label, validation, validation_label, familyofmodelsperconfiguration=1, population_size=0, patience=0, halving_epochs=0, halving_factor=3):
+        # population_size > 0: configurations of the same structure with the same epoch and batch size are trained
+        # together in populations of at most population_size models (see utils/population.py)
+        # patience > 0: every model early stops after patience epochs without a lower validation loss, restoring its best epoch
+        # (with successive halving, best epoch and patience count over all the rounds and early stopped models are never promoted)
+        # halving_epochs > 0: successive halving, all the models are trained for halving_epochs epochs, then only the best
+        # 1/halving_factor of the ones still short of their epoch continue, for halving_factor times more epochs in total, and so on
         print("(GS - MLCUP) - Generating weights")
         weights_per_configuration = [] # confs: [ weight_range_inits:[ weight_inits: [particular weight matrix]]]
         for configuration in self.models_layers:
@@ -90,77 +207,88 @@ class GridSearch:
                     weight_inits.append(weight_init)
                 weights_per_configuration.append(weight_inits)
 
-        # will use range(max(len, 1)) so if any value for whatever list was not provided it will iterate just one time using the default value
-        # max is useless but is more clear what happens if the hyperparameter was not considered
-        # if missing value the class initialize all the lists to the default value
-        # list of tuple (epoch, batch, decay, compiled_model)
-        print("(GS - MLCUP) - Generating models")
-        models_configurations = []
-        counter = 0
-        for i in range(len(weights_per_configuration)):
-            for j in range(len(weights_per_configuration[i])):
-                for epoch_index in range(max(len(self.epoch), 1)):
-                    for batch_size_index in range(max(len(self.batch_size), 1)):
-                        for decay_index in range(max(len(self.lr_decay), 1)):
-                            for eta_index in range(max(len(self.eta), 1)):
-                                for alpha_index in range(max(len(self.alpha), 1)):
-                                    for lambda_index in range(max(len(self._lambda), 1)):
-                                        # initialize model
-                                        model = Model()
-                                        weights_matrix = []
-                                        for k in range(len(weights_per_configuration[i][j])):
-                                            model_layer = self.models_layers[counter//(len(self.weight_range)*familyofmodelsperconfiguration)][k]
-                                            layer = Layer(model_layer.nodes, model_layer.activation_function_type, _input=model_layer.input)
-                                            model._add_layer(layer)
-                                            weights_copy = []
-                                            for node_weights in weights_per_configuration[i][j][k]:
-                                                weights_copy.append([])
-                                                for weight in node_weights:
-                                                    weights_copy[-1].append(weight)
-                                            weights_matrix.append(weights_copy)
-                                        model._compile(eta=self.eta[eta_index], alpha=self.alpha[alpha_index], _lambda=self._lambda[lambda_index], weight_matrix=weights_matrix, isClassification = False, gradient_clipping=True)
-                                        models_configurations.append((self.epoch[epoch_index], self.batch_size[batch_size_index], self.lr_decay[decay_index], model))
-                counter += 1
-        print(f"(GS - MLCUP) - Generated {len(models_configurations)} different models.")
-        print("(GS - MLCUP) - Starting Models Analysis")
-        models_per_structure = len(models_configurations) // len(self.models_layers)
         configurations_per_model = len(self.epoch)*len(self.batch_size)*len(self.lr_decay)*len(self.eta)*len(self.alpha)*len(self._lambda)
+        models_per_structure = len(self.weight_range)*familyofmodelsperconfiguration*configurations_per_model
+        n_models = models_per_structure*len(self.models_layers)
+        print(f"(GS - MLCUP) - Generating {n_models} different models.")
+        print("(GS - MLCUP) - Starting Models Analysis")
 
-        subprocess_pool_size = min(os.cpu_count(), models_per_structure)
-        structures_best_configurations = []
-        for i in range(len(self.models_layers)):
-            print("(GS - MLCUP) - Model ", i)
-            configuration_best_model = [None]*configurations_per_model
-
-            models_training_stats = []      # [[(acc, vacc, loss, vloss), (acc, vacc, loss, vloss)], ...]
-            with Parallel(n_jobs=subprocess_pool_size, verbose=10) as processes:
-                result = processes(delayed(self._train_model)(i*models_per_structure+j, models_configurations[i*models_per_structure + j][3], train, train_label, validation, validation_label, models_configurations[i*models_per_structure + j][1], models_configurations[i*models_per_structure + j][0], models_configurations[i*models_per_structure + j][2]) for j in range(models_per_structure))
-            
-            for res in result:
-                models_training_stats.append(res)
-
-            for j in range(models_per_structure):
-                training_stats = models_training_stats[j]
+        # a single pool for the whole search, fed lazily by the models generator and consumed as soon as results complete
+        # for each configuration the best of its weight initializations is kept, [structure][configuration] -> (vmee, vloss, training_stats, parameters)
+        # initializations are compared in grid order whatever the order they complete in: early results wait in pending_results
+        structures_best_configurations = [[None]*configurations_per_model for _ in range(len(self.models_layers))]
+        pending_results = [[{} for _ in range(configurations_per_model)] for _ in range(len(self.models_layers))]
+        next_result = [[0]*configurations_per_model for _ in range(len(self.models_layers))]
+
+        def collect(index, result):
+            # result is None for models dropped by successive halving
+            i, j = divmod(index, models_per_structure)
+            initialization, configuration = divmod(j, configurations_per_model)
+            pending_results[i][configuration][initialization] = result
+            while next_result[i][configuration] in pending_results[i][configuration]:
+                result = pending_results[i][configuration].pop(next_result[i][configuration])
+                next_result[i][configuration] += 1
+                if result is None:
+                    continue
+                training_stats, parameters = result
                 best_model_vmee = training_stats[-1][1]
                 best_model_vloss = training_stats[-1][3]
-                index = i*models_per_structure + j
-                data = {}
-                with open(f"models/cup_conf{index}", 'rb') as f:
-                    data = pickle.load(f)
-                model = data['model']
-                
-                if configuration_best_model[j%configurations_per_model] is None:
-                    configuration_best_model[j%configurations_per_model] = (best_model_vmee, best_model_vloss, training_stats, model)
-                else:
-                    if configuration_best_model[j%configurations_per_model][0] >= best_model_vmee and configuration_best_model[j%configurations_per_model][1] >= best_model_vloss:
-                        configuration_best_model[j%configurations_per_model] = (best_model_vmee, best_model_vloss, training_stats, model)
+                best = structures_best_configurations[i][configuration]
+                if best is None or (best[0] >= best_model_vmee and best[1] >= best_model_vloss):
+                    structures_best_configurations[i][configuration] = (best_model_vmee, best_model_vloss, training_stats, parameters)
+
+        # one pool for the whole search, a single BLAS thread per worker so that workers do not oversubscribe the cores
+        subprocess_pool_size = min(os.cpu_count(), n_models)
+        busy_time, start_time = 0.0, time.perf_counter()
+        with tempfile.TemporaryDirectory(prefix="gs_mlcup_") as data_folder, parallel_config(backend="loky", inner_max_num_threads=1), \
+             Parallel(n_jobs=subprocess_pool_size, verbose=10, return_as="generator_unordered") as processes:
+            # datasets are published once as read-only memmaps shared by all the workers
+            train, train_label, validation, validation_label = [_shared_array(values, data_folder, name) for values, name in
+                                                                 [(train, "train"), (train_label, "train_label"), (validation, "validation"), (validation_label, "validation_label")]]
+            indexes = self._longest_first(range(n_models), models_per_structure, len(train), budget=halving_epochs if halving_epochs > 0 else math.inf)
+            models = self._generate_models(weights_per_configuration, familyofmodelsperconfiguration, indexes)
+            round_size, trained_epochs = n_models, 0
+            budget = halving_epochs if halving_epochs > 0 else math.inf
+            previous_stats = {} # index -> stats of the previous rounds, for promoted models
+            early_stopping = {} # index -> early stopping state (best loss, epoch and parameters so far), for promoted models
+            while True:
+                if halving_epochs > 0:
+                    print(f"(GS - MLCUP) - Successive halving: {round_size} models up to {budget} epochs")
+                # best models still short of their epoch, at most promoted_size: (-vmee, -index, training_stats, parameters, eta, early_stopping)
+                promoted = []
+                promoted_size = math.ceil(round_size / halving_factor)
+                tasks = self._generate_tasks(self._round_models(models, trained_epochs, budget), models_per_structure, train, train_label, validation, validation_label, population_size, patience, early_stopping)
+                for task_time, result in processes(tasks):
+                    busy_time += task_time
+                    for index, training_stats, parameters, eta, state in result:
+                        training_stats = previous_stats.pop(index, []) + training_stats
+                        epoch = self._get_model_parameters(index%configurations_per_model, configurations_per_model)['epoch']
+                        if state['stopped'] or epoch <= budget:
+                            # early stopped or full epoch reached: the best epoch of the whole training is restored
+                            if state['parameters'] is not None:
+                                training_stats, parameters = training_stats[:state['epoch']+1], state['parameters']
+                            collect(index, (training_stats, parameters))
+                            continue
+                        vmee = training_stats[-1][1]
+                        heapq.heappush(promoted, (-vmee if not np.isnan(vmee) else -math.inf, -index, training_stats, parameters, eta, state))
+                        if len(promoted) > promoted_size:
+                            collect(-heapq.heappop(promoted)[1], None)
+                if len(promoted) == 0:
+                    break
+                previous_stats = {-p[1]: p[2] for p in promoted}
+                early_stopping = {-p[1]: p[5] for p in promoted}
+                promoted = {-p[1]: (-p[1], p[3], p[4]) for p in promoted}
+                indexes = self._longest_first(promoted.keys(), models_per_structure, len(train), budget, budget*halving_factor)
+                models = self._promoted_models([promoted[index] for index in indexes], models_per_structure, configurations_per_model)
+                round_size, trained_epochs, budget = len(promoted), budget, budget*halving_factor
+        elapsed_time = time.perf_counter() - start_time
+        print(f"(GS - MLCUP) - Workers utilization: {busy_time/(elapsed_time*subprocess_pool_size):.1%} ({busy_time:.1f}s of training over {elapsed_time:.1f}s on {subprocess_pool_size} workers)")
 
-            structures_best_configurations.append(configuration_best_model)
-        
         for i in range(len(structures_best_configurations)):
             print("(GS - MLCUP) - Structure", i)
             for j in range(len(structures_best_configurations[i])):
-                print(f"(GS - MLCUP) - Configuration{j} : {structures_best_configurations[i][j][:-2]}")
+                if structures_best_configurations[i][j] is not None:
+                    print(f"(GS - MLCUP) - Configuration{j} : {structures_best_configurations[i][j][:-2]}")
 
         # evaluate models to find best
         best_model_info = None
@@ -171,16 +299,20 @@ class GridSearch:
             scores = []
             stats = []
             params = []
-            models = []
+            models = [] # flat parameters
             confidx = []
             for j in range(len(structures_best_configurations[i])):
+                if structures_best_configurations[i][j] is None: # dropped by successive halving
+                    continue
                 scores.append(self._compute_model_score(structures_best_configurations[i][j]))
                 stats.append(structures_best_configurations[i][j][-2])
                 params.append(self._get_model_parameters(j,len(structures_best_configurations[i])))
                 models.append(structures_best_configurations[i][j][-1])
                 confidx.append(j)
-                models_with_scores.append((scores[-1], models[-1], stats[-1]))
+                models_with_scores.append((scores[-1], i, j, models[-1], stats[-1]))
 
+            if len(scores) == 0:
+                continue
             zipped_triples = sorted(zip(stats, scores, params, confidx, models), key = lambda x : x[1]) # sort everything by increasing score
             max_len = min(len(zipped_triples), 8) # to only get top best results for visualization sake
             stats   =            [x for x,_,_,_,_ in zipped_triples[:max_len]]
@@ -189,25 +321,27 @@ class GridSearch:
             confidx =            [x for _,_,_,x,_ in zipped_triples[:max_len]]
             models  =            [x for _,_,_,_,x in zipped_triples[:max_len]]
             if zipped_triples[0][1] < current_best_score:
-                best_model_info = (zipped_triples[0][-1], params[0], stats[0], self.models_layers[i])
+                best_model_info = (self._restore_model(i, confidx[0], configurations_per_model, models[0]), params[0], stats[0], self.models_layers[i])
                 current_best_score = zipped_triples[0][1]
 
             print(f"(GS - MLCUP) - Model {i} evalutation")
             for j in range(max_len):
                 print(f"(GS - MLCUP) - Configuration {confidx[j]}, score : {scores[j]}, best_validation_mee : {stats[j][-1][1]}, params:{params[j]}")
 
-            Plot._plot_train_stats(stats,title=f"Model {i}", epochs=[x['epoch'] for x in params], block=(i==len(structures_best_configurations)-1), classification=False)
+            Plot._plot_train_stats(stats,title=f"Model {i}", epochs=[len(x) for x in stats], block=(i==len(structures_best_configurations)-1), classification=False)
 
         if best_model_info is None:
             raise SystemError("No model was worth to be evaluated ( all negative score )")
         
-        # save best models for ensemble exec
+        # save best models for ensemble exec, the only models of the search written to disk
         ensemble_dim = 5
         models_with_scores = sorted(models_with_scores, key = lambda x : x[0])
-        for i in range(ensemble_dim):
+        for i in range(min(ensemble_dim, len(models_with_scores))):
+            _, structure_index, configuration_index, parameters, stats = models_with_scores[i]
+            model = self._restore_model(structure_index, configuration_index, configurations_per_model, parameters)
             save_file = f"models/ensemble_models/cup_ensemble{i}"
             with open(save_file, 'wb') as f:
-                pickle.dump({"model": models_with_scores[i][1], "layers": models_with_scores[i][1].layers, "stats": models_with_scores[i][2]}, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump({"model": model, "layers": model.layers, "stats": stats}, f, protocol=pickle.HIGHEST_PROTOCOL)
 
         return best_model_info
 
@@ -227,8 +361,8 @@ class GridSearch:
         alpha_len = max(eta_len // len(self.alpha), 1)
         alpha = self.alpha[index // alpha_len]
         index = index % alpha_len # shift inside single alpha
-        alpha_len = max(alpha_len // len(self.alpha), 1)
-        _lambda = self._lambda[index // alpha_len]
+        lambda_len = max(alpha_len // len(self._lambda), 1)
+        _lambda = self._lambda[index // lambda_len]
 
         return {'epoch':epoch, 'batch_size':batch_size, 'lr_decay':lr_decay, 'eta':eta, 'alpha':alpha, '_lambda':_lambda}
 
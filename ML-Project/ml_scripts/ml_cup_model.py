@@ -89,6 +89,6 @@ gs._set_parameters(layers=layers,
 best_model, model_conf, model_infos, model_architecture = gs._run(train, train_labels, validation, validation_labels)
 print("Best model configuration: ", model_conf)
 print("Best model test accuracy: {:.6f}".format(best_model._infer(test, test_labels)))
-Plot._plot_train_stats([model_infos], epochs=[model_conf['epoch']])
+Plot._plot_train_stats([model_infos], epochs=[len(model_infos)])
 
 print("Ensemble result is:", ensemble_exec(test, test_labels, verbose=False))
\ No newline at end of file
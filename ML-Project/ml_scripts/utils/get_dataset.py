@@ -2,21 +2,49 @@ import csv
 import os
 import numpy as np
 import random
-import copy
+
+def _cached_array(path, columns=slice(1, None), skip_rows=0, delimiter=',', dtype=np.float64):
+    # parsed csv is cached as '.npy' in a '.cache' folder next to the file, keyed by file size and modification time
+    stat = os.stat(path)
+    cache_dir = os.path.join(os.path.dirname(path), '.cache')
+    prefix = os.path.basename(path) + '.'
+    cache_file = os.path.join(cache_dir, f"{prefix}{stat.st_size}.{stat.st_mtime_ns}.npy")
+    if os.path.exists(cache_file):
+        return np.load(cache_file, mmap_mode='r')
+
+    with open(path) as csv_file:
+        rows = list(csv.reader(csv_file, delimiter=delimiter))[skip_rows:]
+    data = np.array([row[columns] for row in rows], dtype=dtype)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_file in os.listdir(cache_dir): # drop caches of previous versions of the file
+        if old_file.startswith(prefix) and old_file.endswith('.npy'):
+            os.remove(os.path.join(cache_dir, old_file))
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp_file, cache_file) # atomic, concurrent readers never see a partial cache
+    return data
+
+def _permutation(n, seed):
+    # shuffling a list of indexes gives the same order as shuffling the lists of rows with the same seed
+    indexes = list(range(n))
+    random.Random(seed).shuffle(indexes)
+    return indexes
 
 # -------------------------------------------------------- MONK -------------------------------------------------------- #
 
 """remember, input is read like: [null, class, val1, val2, val3, val4, val5, val6, label]"""
 
-dataset_path = os.path.dirname(os.path.abspath(__file__))[:-16] + 'monk_dataset\monks-'
+dataset_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'monk_dataset', 'monks-')
 monk_max = [3,3,2,3,4,2]
 
 def _get_train_validation_data(dataset_num, split=0.25, seed=None):
-    inputs, labels = _get_dataset(dataset_num,'train')
+    inputs, labels = _get_dataset_array(dataset_num,'train')
     if seed is None:
         seed = np.random.randint(0,42069)
-    random.Random(seed).shuffle(inputs)
-    random.Random(seed).shuffle(labels)
+    indexes = _permutation(len(inputs), seed)
+    inputs, labels = inputs[indexes].tolist(), labels[indexes].tolist()
     l = int(len(inputs)*split)
     # train, validation, train_labels, validation_labels
     return inputs[l:], inputs[:l], labels[l:], labels[:l]
@@ -26,20 +54,20 @@ def _get_test_data(dataset_num):
 
 def _get_dataset(dataset_num, dataset_type): #dataset_num in [1,2,3] dataset_type in ['train','test']
     # returns 2 lists, first one being dataset requested (either training or test) and second one being data label wrt dataset
+    data_set, data_label = _get_dataset_array(dataset_num, dataset_type)
+    if data_set is None:
+        return None, None
+    return data_set.tolist(), data_label.tolist()
+
+def _get_dataset_array(dataset_num, dataset_type):
+    # same as '_get_dataset' but returns contiguous int arrays
     if dataset_num not in [1,2,3]:
         print('Arguments given are not acceptable!\nPossible nums: 1,2,3')
         return None, None
 
-    data_set = list()
-    data_label = list()
     path = dataset_path + str(dataset_num) + "." + dataset_type
-    with open(path) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=' ')
-        for row in csv_reader:
-            int_row = [int(i) for i in row[1:8]]
-            data_set.append(int_row[1:7])
-            data_label.append(int_row[0])
-    return data_set, data_label
+    rows = _cached_array(path, columns=slice(1, 8), delimiter=' ', dtype=np.int64)
+    return np.ascontiguousarray(rows[:, 1:7]), np.ascontiguousarray(rows[:, 0])
 
 def _get_one_hot_encoding(pattern):
     one_hot_pattern = []
@@ -48,44 +76,39 @@ def _get_one_hot_encoding(pattern):
     return [inp for sublist in one_hot_pattern for inp in sublist]
 
 # -------------------------------------------------------- MLCUP -------------------------------------------------------- #
-cup_path = os.path.dirname(os.path.abspath(__file__))[:-16] + 'ml_cup/ML-CUP20-'
+cup_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))), 'ml_cup', 'ML-CUP20-')
 
 def _get_split_cup(test_split = 0.2, val_split = 0.2, seed=None):
-    inputs, labels = _get_cup()
+    inputs, labels = _get_cup_array()
     if seed is None:
         seed = np.random.randint(0,42069)
-    random.Random(seed).shuffle(inputs)
-    random.Random(seed).shuffle(labels)
+    indexes = _permutation(len(inputs), seed)
+    inputs, labels = inputs[indexes].tolist(), labels[indexes].tolist()
 
     test_l = int(len(inputs)*test_split)
-    test_inputs = copy.deepcopy(inputs[:test_l])
-    test_labels = copy.deepcopy(labels[:test_l])
+    test_inputs = inputs[:test_l]
+    test_labels = labels[:test_l]
     train_val_inputs = inputs[test_l:]
     train_val_labels = labels[test_l:]
     val_l = int(len(inputs)*val_split)
     # train, validation, test, train_labels, validation_labels, test_labels
     return train_val_inputs[val_l:], train_val_inputs[:val_l], test_inputs, train_val_labels[val_l:], train_val_labels[:val_l], test_labels
 
-
 def _get_cup(dataset_type='train'): # can either be train or set
+    data_set, data_label = _get_cup_array(dataset_type)
+    if data_set is None:
+        return None, None
+    return data_set.tolist(), (None if data_label is None else data_label.tolist())
+
+def _get_cup_array(dataset_type='train'):
+    # same as '_get_cup' but returns contiguous float arrays
     if dataset_type not in ['train','test']:
         print('Arguments given are not acceptable!\nPossible datasets: train - test')
         return None, None
 
-    data_set = list()
-    data_label = list()
     path = cup_path + ("TR" if dataset_type == "train" else "TS") + ".csv"
-    with open(path) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        rows = [row for row in csv_reader]
-        if dataset_type == 'train':
-            for row in rows[7:]:
-                float_row = [float(i) for i in row[1:]]
-                data_set.append(float_row[0:-2])
-                data_label.append(float_row[-2:])
-        else: # test data
-            for row in rows[7:]:
-                float_row = [float(i) for i in row[1:]]
-                data_set.append(float_row)
-            data_label = None
-    return data_set, data_label
\ No newline at end of file
+    rows = _cached_array(path, skip_rows=7)
+    if dataset_type == 'train':
+        return np.ascontiguousarray(rows[:, :-2]), np.ascontiguousarray(rows[:, -2:])
+    # test data
+    return np.array(rows), None
@@ -21,8 +21,9 @@ class Layer:
             self.weights_range = w_range
         if seed is not None:
             np.random.seed(seed)
-        self.weights = np.random.uniform(self.weights_range[0], self.weights_range[1], (self.nodes, self.input[0])) if weigths is None else weigths
-        self.bias = np.random.uniform(self.bias_range[0], self.bias_range[1], self.nodes) if bias is None else bias
+        # given weights and bias (e.g. nested lists) are copied into arrays, updated in place during training
+        self.weights = np.random.uniform(self.weights_range[0], self.weights_range[1], (self.nodes, self.input[0])) if weigths is None else np.array(weigths, dtype=float)
+        self.bias = np.random.uniform(self.bias_range[0], self.bias_range[1], self.nodes) if bias is None else np.array(bias, dtype=float)
         self.activation_function = AF[self.activation_function_type]
     
     def _feed_forward(self, inputs):
@@ -33,6 +34,22 @@ class Layer:
             self.output.append(self.activation_function._compute(self.net[-1]))
         return self.output
 
+    def _feed_forward_batch(self, inputs):
+        # inputs is a matrix with one pattern per row, net and output have one row per pattern
+        self.net = np.dot(inputs, np.transpose(self.weights)) + self.bias
+        self.output = self.activation_function._compute(self.net)
+        return self.output
+
+    def _back_propagation_batch(self, output_prev_layer, is_output_layer=False, loss_prime_values=None, deltas_next_layer=None, weights_next_layer=None):
+        # same as _back_propagation over a whole batch: deltas have one row per pattern,
+        # weight deltas are already summed over the batch (X^T * delta)
+        if is_output_layer:
+            # take [-] Gradient !!
+            delta = -loss_prime_values*self.activation_function._gradient(self.net)
+        else:
+            delta = np.dot(deltas_next_layer, weights_next_layer)*self.activation_function._gradient(self.net)
+        return delta, np.dot(delta.T, output_prev_layer)
+
     def _back_propagation(self, output_prev_layer, is_output_layer=False, loss_prime_values=[], deltas_next_layer=None, weights_next_layer=None):
         weight_delta = []
         delta = []
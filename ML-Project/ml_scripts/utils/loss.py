@@ -5,6 +5,10 @@ class Mse:
         assert(len(actual) == len(expected))
         return (0.5 * np.sum((np.array(expected) - np.array(actual))**2)) / len(expected)
 
+    def _compute_loss_batch(self, actual, expected): # one row per pattern, returns the loss of every pattern
+        # leading axes are kept, (P, batch, out) outputs of a population give (P, batch) losses
+        return (0.5 * np.sum((expected - actual)**2, axis=-1)) / expected.shape[-1]
+
     def _compute_loss_prime(self, actual, expected): # even if multiple output this will receive one comparison at a time (look ad model.py)
         return expected - actual
 
@@ -29,38 +29,90 @@ class Model:
         self.task = isClassification # True for Classification, False for Regression
         self.metric_function = self._compute_accuracy if isClassification else self._compute_euclidean_error
         self.grad_clip = gradient_clipping
+        self._flatten_parameters()
 
-    def _init_batch(self):
-        self.batch_loss = 0
+    def _flatten_parameters(self):
+        # all parameters in one contiguous buffer (weights of every layer first, then biases), layers work on views of it.
+        # gradients and momentum buffers have the same layout
+        layers_parameters = [(np.array(layer.weights, dtype=float), np.array(layer.bias, dtype=float)) for layer in self.layers]
+        self.n_weights = sum(layer.nodes*layer.input[0] for layer in self.layers)
+        size = self.n_weights + sum(layer.nodes for layer in self.layers)
+        self.parameters = np.empty(size)
+        self.gradients = np.zeros(size)
+        self.momentum = np.zeros(size)
+        self._bind_parameters()
+        for layer, (weights, bias) in zip(self.layers, layers_parameters):
+            layer.weights[...] = weights
+            layer.bias[...] = bias
+
+    def _bind_parameters(self):
+        # point layers weights, bias, deltas and previous deltas to their views of the flat buffers
+        w_start, b_start = 0, self.n_weights
         self.batch_deltas = []
         self.batch_weights_delta = []
         for layer in self.layers:
-            self.batch_deltas.append(np.zeros(layer.nodes))
-            self.batch_weights_delta.append(np.zeros((layer.nodes, layer.input[0])))
+            shape = (layer.nodes, layer.input[0])
+            w_end, b_end = w_start + shape[0]*shape[1], b_start + layer.nodes
+            layer.weights, layer.bias = self.parameters[w_start:w_end].reshape(shape), self.parameters[b_start:b_end]
+            layer.weight_delta, layer.bias_delta = self.gradients[w_start:w_end].reshape(shape), self.gradients[b_start:b_end]
+            layer.weight_delta_prev, layer.bias_delta_prev = self.momentum[w_start:w_end].reshape(shape), self.momentum[b_start:b_end]
+            self.batch_weights_delta.append(layer.weight_delta)
+            self.batch_deltas.append(layer.bias_delta)
+            w_start, b_start = w_end, b_end
+
+    def _get_parameters(self):
+        # copy of all the parameters as one flat array (checkpoints, transfer between processes)
+        return self.parameters.copy()
+
+    def _set_parameters(self, parameters):
+        np.copyto(self.parameters, parameters)
+
+    def __getstate__(self):
+        # gradients and momentum are reset at every batch/epoch, views are rebuilt when loading
+        state = self.__dict__.copy()
+        for key in ['gradients', 'momentum', 'batch_deltas', 'batch_weights_delta']:
+            state.pop(key, None)
+        if 'parameters' in state:
+            # layers weights, bias and deltas are views of the flat buffers, net and output are per batch
+            layer_keys = ['weights', 'bias', 'weight_delta', 'bias_delta', 'weight_delta_prev', 'bias_delta_prev', 'net', 'output']
+            state['layers'] = [self._strip_layer(layer, layer_keys) for layer in self.layers]
+        return state
+
+    @staticmethod
+    def _strip_layer(layer, keys):
+        stripped = object.__new__(type(layer))
+        stripped.__dict__.update({key: value for key, value in layer.__dict__.items() if key not in keys})
+        return stripped
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'parameters' in state:
+            self.gradients = np.zeros(self.parameters.size)
+            self.momentum = np.zeros(self.parameters.size)
+            self._bind_parameters()
+        elif self.layers and hasattr(self.layers[0], 'weights'): # models saved before the flat buffer was introduced
+            self._flatten_parameters()
+
+    def _init_batch(self):
+        self.batch_loss = 0
+        self.gradients.fill(0)
     
     def _apply_decay(self, epoch_decay):
         # various other learning rate schedulers could be implemented
         self.eta = max(self.stopping_eta, self.eta/(1 + epoch_decay))
 
-    def _init_epoch(self, epoch_decay, inp, exp):
+    def _init_epoch(self, epoch_decay, indexes):
+        # only the patterns order is shuffled (same permutation the data itself used to get), data is never copied or moved
         self.eval_metric = 0
-        for layer in self.layers:
-            layer.weight_delta_prev = np.zeros((layer.nodes, layer.input[0]))
-            layer.bias_delta_prev = np.zeros(layer.nodes)
+        self.momentum.fill(0)
         self._apply_decay(epoch_decay) # update learning rate
         seed = np.random.randint(0,1000)
-        random.Random(seed).shuffle(inp)
-        random.Random(seed).shuffle(exp)
+        random.Random(seed).shuffle(indexes)
 
     def _accumulate_batch_back_prop(self, layer_bp, layer_index):
         # accumulate deltas of single pattern for batch learning
-        # bias
-        for i in range(len(self.batch_deltas[layer_index])):
-            self.batch_deltas[layer_index][i] += layer_bp[0][i]
-        # weights
-        for i in range(len(self.batch_weights_delta[layer_index])):
-            for j in range(len(self.batch_weights_delta[layer_index][i])):
-                self.batch_weights_delta[layer_index][i][j] += layer_bp[1][i][j]
+        self.batch_deltas[layer_index] += np.array(layer_bp[0], dtype=float) # bias
+        self.batch_weights_delta[layer_index] += np.array(layer_bp[1], dtype=float) # weights
 
     def _feed_forward(self, _input):
         layer_output = _input
@@ -68,6 +120,27 @@ class Model:
             layer_output = self.layers[i]._feed_forward(layer_output)
         return layer_output
 
+    def _feed_forward_batch(self, inputs):
+        # whole batch at once, one pattern per row
+        layer_output = inputs
+        for layer in self.layers:
+            layer_output = layer._feed_forward_batch(layer_output)
+        return layer_output
+
+    def _back_propagation_batch(self, expected, inp):
+        # same as _back_propagation, over the whole batch (one pattern per row), accumulating the summed deltas
+        delta_last_layer = None
+        for i in range(len(self.layers)-1, -1, -1):
+            output_prev_layer = inp if i == 0 else self.layers[i-1].output
+            if i == len(self.layers)-1: # output layer
+                loss_prime = self.loss_function._compute_loss_prime(self.model_output, expected)
+                result = self.layers[i]._back_propagation_batch(output_prev_layer, is_output_layer=True, loss_prime_values=loss_prime)
+            else:
+                result = self.layers[i]._back_propagation_batch(output_prev_layer, deltas_next_layer=delta_last_layer, weights_next_layer=self.layers[i+1].weights)
+            self.batch_deltas[i] += np.sum(result[0], axis=0)
+            self.batch_weights_delta[i] += result[1]
+            delta_last_layer = result[0]
+
     def _back_propagation(self, expected, inp):
         # order = from output layer to input layer
         delta_last_layer = None # will be used from second iteration and on
@@ -84,48 +157,47 @@ class Model:
             self._accumulate_batch_back_prop(result,i)
             delta_last_layer = result[0]
 
-    def _update_layers_deltas(self, batch_size):
-        # copy deltas value into each layer for easier later weight and bias update
-        for i in range(len(self.layers)):
-            self.layers[i].bias_delta = self.batch_deltas[i]
-            self.layers[i].weight_delta = self.batch_weights_delta[i]
-
     def _update_weights_bias(self):
-        for i in range(len(self.layers)):
-            for j in range(len(self.layers[i].weights)):
-                multiplier = 1
-                if self.grad_clip:
-                    clipping_ts = 800 # to be set wrt the model behaviour (empirically obtained)
-                    gradient_norm = np.linalg.norm(self.layers[i].weight_delta[j])
-                    if gradient_norm > clipping_ts:
-                        multiplier = (clipping_ts / gradient_norm)
-
-                for k in range(len(self.layers[i].weights[j])):
-                    # weight_n = weight_o - eta*delta(W) + alpha*delta_prev(W) - 2*lambda*weight_o
-                    self.layers[i].weight_delta[j][k] *= multiplier # gradient clipping
-                    self.layers[i].weight_delta_prev[j][k] = - self.eta * self.layers[i].weight_delta[j][k] + self.alpha * self.layers[i].weight_delta_prev[j][k]
-                    self.layers[i].weights[j][k] = self.layers[i].weights[j][k] + self.layers[i].weight_delta_prev[j][k] - 2 * self._lambda * self.layers[i].weights[j][k]
-                # bias_n = bias_o - eta*delta(W) + alpha*delta_prev(W)
-                self.layers[i].bias_delta_prev[j] = - self.eta * self.layers[i].bias_delta[j] + self.alpha * self.layers[i].bias_delta_prev[j]
-                self.layers[i].bias[j] = self.layers[i].bias[j] + self.layers[i].bias_delta_prev[j]
+        if self.grad_clip:
+            clipping_ts = 800 # to be set wrt the model behaviour (empirically obtained)
+            for layer in self.layers:
+                # each neuron's weight gradient is scaled down to norm clipping_ts if it exceeds it
+                gradient_norms = np.linalg.norm(layer.weight_delta, axis=1)
+                layer.weight_delta *= (clipping_ts / np.maximum(gradient_norms, clipping_ts))[:, np.newaxis]
+        # whole flat buffers updated in place, weights and bias together
+        # weight_n = weight_o - eta*delta(W) + alpha*delta_prev(W) - 2*lambda*weight_o
+        # bias_n = bias_o - eta*delta(W) + alpha*delta_prev(W)
+        self.momentum *= self.alpha
+        self.momentum -= self.eta * self.gradients
+        self.parameters[:self.n_weights] *= 1 - 2 * self._lambda
+        self.parameters += self.momentum
 
     def _ridge_regression(self):
-        sum_squares = 0
-        for layer in self.layers:
-            for i in range(len(layer.weights)):
-                for j in range(len(layer.weights[i])):
-                    sum_squares += layer.weights[i][j]**2
-        return self._lambda*sum_squares
+        weights = self.parameters[:self.n_weights]
+        return self._lambda*np.dot(weights, weights)
+
+    def _batch_metric(self, output, expected):
+        # sum of the metric over a batch (one pattern per row)
+        return self._compute_accuracy_batch(output, expected) if self.task else self._compute_euclidean_error_batch(output, expected)
 
     # test the model on a set of inputs, return eval_metric
-    def _infer(self, inputs, expected):
+    def _infer(self, inputs, expected, vectorized=True):
+        if vectorized:
+            inputs, expected = np.asarray(inputs, dtype=float), _as_matrix(expected, len(inputs))
+            return self._batch_metric(self._feed_forward_batch(inputs), expected)/len(inputs)
         test_eval_metric = 0
         for i in range(len(inputs)):
             output = self._feed_forward(inputs[i])
             test_eval_metric = self.metric_function(output, expected[i], test_eval_metric)
         return test_eval_metric/len(inputs)
 
-    def _validation_validation_validation(self, inputs, expected):
+    def _validation_validation_validation(self, inputs, expected, vectorized=True):
+        if vectorized:
+            inputs, expected = np.asarray(inputs, dtype=float), _as_matrix(expected, len(inputs))
+            output = self._feed_forward_batch(inputs)
+            self.validation_eval_metric = self._batch_metric(output, expected)/len(inputs)
+            self.validation_loss = np.mean(self.loss_function._compute_loss_batch(output, expected))
+            return
         self.validation_eval_metric = 0
         self.validation_loss = 0
         for i in range(len(inputs)):
@@ -134,37 +206,76 @@ class Model:
             self.validation_loss += self.loss_function._compute_loss(output, expected[i])/len(inputs)
         self.validation_eval_metric /= len(inputs)
 
-    def _train(self, train_inputs, train_expected, val_inputs, val_expected, batch_size=1, epoch=100, decay=1e-5, verbose=False):
+    def _train_batch(self, batch_inputs, batch_expected):
+        # one matrix product per layer over the whole batch, returns the summed (not regularized) loss
+        self._init_batch()
+        batch_inputs, batch_expected = np.asarray(batch_inputs, dtype=float), _as_matrix(batch_expected, len(batch_inputs))
+        self.model_output = self._feed_forward_batch(batch_inputs) # compute predictions
+        model_batch_loss_nr = np.sum(self.loss_function._compute_loss_batch(self.model_output, batch_expected)) # calculate loss
+        self.batch_loss = model_batch_loss_nr / len(batch_inputs) + self._ridge_regression() # weights do not change within the batch
+        self._back_propagation_batch(batch_expected, batch_inputs) # compute back-propagation
+        self.eval_metric += self._batch_metric(self.model_output, batch_expected)
+        self._update_weights_bias() # update weights & bias
+        return model_batch_loss_nr
+
+    def _train(self, train_inputs, train_expected, val_inputs, val_expected, batch_size=1, epoch=100, decay=1e-5, verbose=False, vectorized=True, patience=0, early_stopping=None):
+        # vectorized: every batch goes through the layers as a matrix, otherwise pattern by pattern (same updates)
+        # patience > 0: early stopping after patience epochs without a lower validation loss,
+        # parameters of the best epoch are restored and stats are returned up to that epoch
+        # early_stopping: state of a training to be continued (see _early_stopping_state), updated in place; best epoch
+        # and patience count over all the calls, restoring the best epoch (when state['parameters'] is not None) is left to the caller
+        # inputs and expected values can be lists or arrays (e.g. read-only memmaps), they are converted once and never modified
         self.batch_size = batch_size
         self.decay_ratio = decay
         train_stats = []
+        state = _early_stopping_state() if early_stopping is None else early_stopping
+        trained_epochs = state['epochs'] # epochs of the previous calls
         assert(len(train_inputs) == len(train_expected) and len(val_inputs) == len(val_expected))
+        train_inputs, train_expected = np.asarray(train_inputs, dtype=float), _as_matrix(train_expected, len(train_inputs))
+        val_inputs, val_expected = np.asarray(val_inputs, dtype=float), _as_matrix(val_expected, len(val_inputs))
+        indexes = list(range(len(train_inputs))) # patterns order, shuffled every epoch
         for e in range(epoch):
-            self._init_epoch(decay*epoch, train_inputs, train_expected)
+            self._init_epoch(decay*epoch, indexes)
+            order = np.array(indexes)
             model_epoch_loss_nr = 0.0
             for i in range(0, len(train_inputs), batch_size): # for all inputs
+                if vectorized:
+                    batch = order[i:i+batch_size] # one gather per batch
+                    model_epoch_loss_nr += self._train_batch(train_inputs[batch], train_expected[batch]) / len(batch)
+                    continue
                 j = i
                 self._init_batch()
                 model_batch_loss_nr = 0.0
+                ridge = self._ridge_regression() # weights do not change within the batch
                 while j < len(train_inputs) and j-i < batch_size: # iterate over batch
-                    self.model_output = self._feed_forward(train_inputs[j]) # compute prediction
-                    model_batch_loss_nr += self.loss_function._compute_loss(self.model_output, train_expected[j]) # calculate loss
-                    self.batch_loss += self.loss_function._compute_loss(self.model_output, train_expected[j]) + self._ridge_regression()
-                    self._back_propagation(train_expected[j], train_inputs[j]) # compute back-propagation
-                    self.eval_metric = self.metric_function(self.model_output, train_expected[j], self.eval_metric)
+                    pattern_inputs, pattern_expected = train_inputs[order[j]], train_expected[order[j]]
+                    self.model_output = self._feed_forward(pattern_inputs) # compute prediction
+                    model_batch_loss_nr += self.loss_function._compute_loss(self.model_output, pattern_expected) # calculate loss
+                    self.batch_loss += self.loss_function._compute_loss(self.model_output, pattern_expected) + ridge
+                    self._back_propagation(pattern_expected, pattern_inputs) # compute back-propagation
+                    self.eval_metric = self.metric_function(self.model_output, pattern_expected, self.eval_metric)
                     j += 1
                 self.batch_loss = self.batch_loss / (j - i) # to avoid a bigger division on a smaller than batch size last subset of inputs
                 model_epoch_loss_nr += model_batch_loss_nr / (j-i)
-                self._update_layers_deltas(j - i)
                 self._update_weights_bias() # update weights & bias
             self.eval_metric /= len(train_inputs)
-            self._validation_validation_validation(val_inputs, val_expected)
+            self._validation_validation_validation(val_inputs, val_expected, vectorized)
             model_epoch_loss_nr = model_epoch_loss_nr/(len(train_inputs)/batch_size) if len(train_inputs) % batch_size == 0 else model_epoch_loss_nr/(len(train_inputs)/batch_size) + 1
             if verbose:
                 print("Epoch {:4d} - LR: {:.6f} - Train_Eval_Metric: {:.6f} - Train_Loss: {:.6f} - Validation_Eval_Metric: {:.6f} - Validation_Loss: {:.6f}"
                     .format(e, self.eta, self.eval_metric, model_epoch_loss_nr, self.validation_eval_metric, self.validation_loss)) 
             train_stats.append((self.eval_metric, self.validation_eval_metric, model_epoch_loss_nr, self.validation_loss))
-            
+            if patience > 0:
+                if self.validation_loss < state['validation_loss']:
+                    state.update(validation_loss=self.validation_loss, epoch=trained_epochs+e, parameters=self._get_parameters())
+                elif trained_epochs + e - state['epoch'] >= patience:
+                    state['stopped'] = True
+                    break
+
+        state['epochs'] = trained_epochs + len(train_stats)
+        if early_stopping is None and state['parameters'] is not None:
+            self._set_parameters(state['parameters'])
+            train_stats = train_stats[:state['epoch']+1]
         return train_stats
 
     def __str__(self):
@@ -182,4 +293,18 @@ class Model:
 
     def _compute_euclidean_error(self, output, expected, current_euclidean_error):
         assert(len(output) == len(expected))
-        return current_euclidean_error + np.sqrt(np.sum((np.array(expected) - np.array(output))**2))
\ No newline at end of file
+        return current_euclidean_error + np.sqrt(np.sum((np.array(expected) - np.array(output))**2))
+
+    def _compute_accuracy_batch(self, output, expected):
+        return np.sum(np.abs(output - expected) < 0.5) / expected.shape[1]
+
+    def _compute_euclidean_error_batch(self, output, expected):
+        return np.sum(np.sqrt(np.sum((expected - output)**2, axis=1)))
+
+def _early_stopping_state():
+    # best validation loss, its epoch and parameters, epochs trained so far and whether patience ran out
+    return {'validation_loss': np.inf, 'epoch': -1, 'parameters': None, 'epochs': 0, 'stopped': False}
+
+def _as_matrix(values, n_patterns):
+    # expected values as a matrix with one pattern per row (also when given one scalar per pattern)
+    return np.asarray(values, dtype=float).reshape(n_patterns, -1)
\ No newline at end of file
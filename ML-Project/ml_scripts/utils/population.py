@@ -0,0 +1,159 @@
+import numpy as np
+import random
+
+from .model import _early_stopping_state
+
+class Population:
+    # trains P compiled models with the same architecture at once: parameters are stacked into a (P, size) buffer
+    # (each row laid out as Model.parameters), so every layer runs as one batched matmul over all the models.
+    # eta, alpha, lambda, stopping eta and decay are vectors with one value per model.
+    # All the models see the same minibatches (one shuffle per epoch for the whole population)
+
+    def __init__(self, models):
+        self.models = models
+        first = models[0]
+        for model in models:
+            assert([(l.nodes, l.input[0], l.activation_function_type) for l in model.layers] == [(l.nodes, l.input[0], l.activation_function_type) for l in first.layers]), "models must share the same architecture"
+            assert(model.grad_clip == first.grad_clip and model.task == first.task and model.loss_function_name == first.loss_function_name), "models must share clipping, task and loss"
+        self.size = len(models)
+        self.layers = first.layers # shapes and activation functions
+        self.loss_function = first.loss_function
+        self.task = first.task
+        self.grad_clip = first.grad_clip
+        self.n_weights = first.n_weights
+        self.parameters = np.stack([model.parameters for model in models])
+        self.gradients = np.zeros(self.parameters.shape)
+        self.momentum = np.zeros(self.parameters.shape)
+        self.eta = np.array([model.eta for model in models], dtype=float)
+        self.stopping_eta = np.array([model.stopping_eta for model in models], dtype=float)
+        self.alpha = np.array([model.alpha for model in models], dtype=float)[:, np.newaxis]
+        self._lambda = np.array([model._lambda for model in models], dtype=float)[:, np.newaxis]
+        self._bind_parameters()
+
+    def _bind_parameters(self):
+        # (P, nodes, inputs) and (P, nodes) views of the stacked buffers, one per layer
+        self.weights, self.bias, self.weight_delta, self.bias_delta = [], [], [], []
+        w_start, b_start = 0, self.n_weights
+        for layer in self.layers:
+            shape = (self.size, layer.nodes, layer.input[0])
+            w_end, b_end = w_start + layer.nodes*layer.input[0], b_start + layer.nodes
+            self.weights.append(self.parameters[:, w_start:w_end].reshape(shape))
+            self.bias.append(self.parameters[:, b_start:b_end])
+            self.weight_delta.append(self.gradients[:, w_start:w_end].reshape(shape))
+            self.bias_delta.append(self.gradients[:, b_start:b_end])
+            w_start, b_start = w_end, b_end
+
+    def _feed_forward_batch(self, inputs):
+        # inputs is (batch, inputs), shared by all the models, outputs are (P, batch, nodes)
+        self.net, self.output = [], []
+        layer_output = inputs
+        for i, layer in enumerate(self.layers):
+            self.net.append(np.matmul(layer_output, self.weights[i].transpose(0, 2, 1)) + self.bias[i][:, np.newaxis, :])
+            self.output.append(layer.activation_function._compute(self.net[-1]))
+            layer_output = self.output[-1]
+        return layer_output
+
+    def _back_propagation_batch(self, expected, inp):
+        # same as Model._back_propagation_batch, for every model at once
+        delta = None
+        for i in range(len(self.layers)-1, -1, -1):
+            gradient = self.layers[i].activation_function._gradient(self.net[i])
+            if i == len(self.layers)-1: # output layer
+                # take [-] Gradient !!
+                delta = -self.loss_function._compute_loss_prime(self.output[i], expected)*gradient
+            else:
+                delta = np.matmul(delta, self.weights[i+1])*gradient
+            output_prev_layer = inp if i == 0 else self.output[i-1]
+            self.weight_delta[i] += np.matmul(delta.transpose(0, 2, 1), output_prev_layer)
+            self.bias_delta[i] += np.sum(delta, axis=1)
+
+    def _update_weights_bias(self):
+        if self.grad_clip:
+            clipping_ts = 800 # same as Model
+            for weight_delta in self.weight_delta:
+                gradient_norms = np.linalg.norm(weight_delta, axis=2)
+                weight_delta *= (clipping_ts / np.maximum(gradient_norms, clipping_ts))[:, :, np.newaxis]
+        self.momentum *= self.alpha
+        self.momentum -= self.eta[:, np.newaxis] * self.gradients
+        self.parameters[:, :self.n_weights] *= 1 - 2 * self._lambda
+        self.parameters += self.momentum
+
+    def _metric(self, output, expected):
+        # sum of the metric over the batch, one value per model
+        if self.task:
+            return np.sum(np.abs(output - expected) < 0.5, axis=(1, 2)) / expected.shape[1]
+        return np.sum(np.sqrt(np.sum((expected - output)**2, axis=2)), axis=1)
+
+    def _loss(self, output, expected):
+        # loss of every pattern, (P, batch)
+        return self.loss_function._compute_loss_batch(output, expected)
+
+    def _train(self, train_inputs, train_expected, val_inputs, val_expected, batch_size=1, epoch=100, decay=1e-5, verbose=False, patience=0, early_stopping=None):
+        # same training loop as Model._train (decay can also be one value per model), returns one train_stats list per model
+        # with early stopping (patience > 0) a stopped model keeps going through the batches with the others, but its
+        # learning rate, best epoch and returned parameters are frozen as Model._train would leave them; training ends when every model stopped
+        # early_stopping: one Model._train state per model, updated in place (a model stopped without ever improving keeps
+        # its parameters and epoch of the stop as best), restoring the best epochs is then left to the caller
+        decay = np.broadcast_to(np.array(decay, dtype=float), (self.size,))
+        train_inputs = np.asarray(train_inputs, dtype=float)
+        train_expected = np.asarray(train_expected, dtype=float).reshape(len(train_inputs), -1)
+        val_inputs = np.asarray(val_inputs, dtype=float)
+        val_expected = np.asarray(val_expected, dtype=float).reshape(len(val_inputs), -1)
+        indexes = list(range(len(train_inputs)))
+        train_stats = [[] for _ in range(self.size)]
+        states = [_early_stopping_state() for _ in range(self.size)] if early_stopping is None else early_stopping
+        best_validation_loss = np.array([state['validation_loss'] for state in states], dtype=float)
+        best_epoch = np.array([state['epoch'] for state in states])
+        best_parameters = np.stack([self.parameters[p] if state['parameters'] is None else state['parameters'] for p, state in enumerate(states)])
+        stopped = np.array([state['stopped'] for state in states])
+        trained_epochs = np.array([state['epochs'] for state in states]) # epochs of the previous calls
+        for e in range(epoch):
+            # as Model._init_epoch: reset momentum, decay learning rates, shuffle (indexes instead of the data itself)
+            self.momentum.fill(0)
+            self.eta = np.where(stopped, self.eta, np.maximum(self.stopping_eta, self.eta/(1 + decay*epoch)))
+            random.Random(np.random.randint(0,1000)).shuffle(indexes)
+            eval_metric = np.zeros(self.size)
+            epoch_loss = np.zeros(self.size)
+            for i in range(0, len(train_inputs), batch_size):
+                batch = indexes[i:i+batch_size]
+                batch_inputs, batch_expected = train_inputs[batch], train_expected[batch]
+                self.gradients.fill(0)
+                output = self._feed_forward_batch(batch_inputs)
+                epoch_loss += np.sum(self._loss(output, batch_expected), axis=1) / len(batch)
+                self._back_propagation_batch(batch_expected, batch_inputs)
+                eval_metric += self._metric(output, batch_expected)
+                self._update_weights_bias()
+            eval_metric /= len(train_inputs)
+            epoch_loss = epoch_loss/(len(train_inputs)/batch_size) if len(train_inputs) % batch_size == 0 else epoch_loss/(len(train_inputs)/batch_size) + 1
+            val_output = self._feed_forward_batch(val_inputs)
+            val_metric = self._metric(val_output, val_expected) / len(val_inputs)
+            val_loss = np.mean(self._loss(val_output, val_expected), axis=1)
+            if verbose:
+                print("Epoch {:4d} - Best Train_Eval_Metric: {:.6f} - Best Validation_Eval_Metric: {:.6f}".format(e, np.min(eval_metric), np.min(val_metric)))
+            for p in range(self.size):
+                train_stats[p].append((eval_metric[p], val_metric[p], epoch_loss[p], val_loss[p]))
+            if patience > 0:
+                improved = ~stopped & (val_loss < best_validation_loss)
+                best_validation_loss[improved], best_epoch[improved] = val_loss[improved], trained_epochs[improved] + e
+                best_parameters[improved] = self.parameters[improved]
+                stopping = ~stopped & (trained_epochs + e - best_epoch >= patience)
+                never_improved = stopping & (best_epoch < 0) # kept as they are when stopping
+                best_parameters[never_improved], best_epoch[never_improved] = self.parameters[never_improved], trained_epochs[never_improved] + e
+                stopped |= stopping
+                if np.all(stopped):
+                    break
+
+        for p, state in enumerate(states):
+            state.update(validation_loss=best_validation_loss[p], epoch=int(best_epoch[p]), parameters=best_parameters[p].copy() if best_epoch[p] >= 0 else None,
+                         epochs=int(trained_epochs[p]) + len(train_stats[p]), stopped=bool(stopped[p]))
+        if early_stopping is None:
+            restore = best_epoch >= 0
+            self.parameters[restore] = best_parameters[restore]
+            train_stats = [stats[:best_epoch[p]+1] if restore[p] else stats for p, stats in enumerate(train_stats)]
+        # hand trained parameters back to every model
+        for p, model in enumerate(self.models):
+            model._set_parameters(self.parameters[p])
+            model.eta = self.eta[p]
+            model.batch_size = batch_size
+            model.decay_ratio = decay[p]
+        return train_stats
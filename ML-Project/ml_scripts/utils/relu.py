@@ -2,10 +2,10 @@ import numpy as np
 
 class Relu:
     def _compute(self, input):
-        return np.max([0, input])
+        return np.maximum(0, input)
 
     def _gradient(self, input):
-        return 0 if input < 0 else 1
+        return np.where(input < 0, 0, 1)
 
     def __str__(self):
         return "Relu"
\ No newline at end of file